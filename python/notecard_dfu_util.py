@@ -6,7 +6,13 @@ also known as the serial number.
 """
 
 import argparse
+import json
+import os
+import re
 import subprocess
+import tempfile
+
+import notecard_ledger
 
 _found_dfu = "Found DFU: "
 
@@ -56,6 +62,147 @@ def parse_dfu_output(lines: list[str]) -> list[dict]:
     return [parse_dfu_line(line) for line in lines if is_dfu_line(line)]
 
 
+_dfuse_sector = re.compile(r"^\s*(\d+)\*(\d+)\s*([ BKM])([a-g])\s*$")
+_dfuse_units = {" ": 1, "B": 1, "K": 1024, "M": 1024 * 1024}
+
+# DfuSe sector properties are a letter, 'a' to 'g', encoding these flags as a 1-based bitmask
+dfuse_readable = 1
+dfuse_erasable = 2
+dfuse_writable = 4
+
+
+def parse_dfuse_layout(name: str) -> dict:
+    """
+    Parse a DfuSe memory layout string, as given by the `name` of a DFU interface, into its regions and sectors.
+
+    Each region gives its start address, total size and sector groups. Each sector group gives the number of sectors,
+    the size of each sector and the DfuSe properties letter.
+
+    >>> parse_dfuse_layout("@Internal Flash  /0x08000000/512*0004Kg")
+    {'name': 'Internal Flash', 'regions': [{'address': 134217728, 'size': 2097152, 'sectors': [{'count': 512, 'size': 4096, 'properties': 'g'}]}]}
+    >>> [(hex(r["address"]), r["size"]) for r in parse_dfuse_layout("@Option Bytes  /0x1FF00000/01*040 e/0x1FF01000/01*040 e")["regions"]]
+    [('0x1ff00000', 40), ('0x1ff01000', 40)]
+    >>> [s["size"] for s in parse_dfuse_layout("@Flash /0x08000000/04*016Kg,01*064Kg,07*128Kg")["regions"][0]["sectors"]]
+    [16384, 65536, 131072]
+    """
+    if not name.startswith("@"):
+        raise ValueError(f"not a DfuSe layout: {name}")
+    parts = name[1:].split("/")
+    if len(parts) < 3 or len(parts) % 2 == 0:
+        raise ValueError(f"malformed DfuSe layout: {name}")
+
+    regions = []
+    for address, sector_groups in zip(parts[1::2], parts[2::2]):
+        sectors = []
+        for group in sector_groups.split(","):
+            match = _dfuse_sector.match(group)
+            if not match:
+                raise ValueError(f"malformed DfuSe sectors {group!r} in {name}")
+            count, size, unit, properties = match.groups()
+            sectors.append({"count": int(count), "size": int(size) * _dfuse_units[unit], "properties": properties})
+        regions.append({"address": int(address, 16),
+                        "size": sum(sector["count"] * sector["size"] for sector in sectors),
+                        "sectors": sectors})
+    return {"name": parts[0].strip(), "regions": regions}
+
+
+def sector_table(region: dict) -> list[tuple[int, int]]:
+    """
+    List the address and size of every sector in a region.
+
+    >>> sector_table({"address": 0x100, "sectors": [{"count": 2, "size": 16}, {"count": 1, "size": 32}]})
+    [(256, 16), (272, 16), (288, 32)]
+    """
+    table = []
+    address = region["address"]
+    for group in region["sectors"]:
+        for _ in range(group["count"]):
+            table.append((address, group["size"]))
+            address += group["size"]
+    return table
+
+
+def _properties(sector_group: dict) -> int:
+    return ord(sector_group["properties"]) - ord("a") + 1
+
+
+def find_layout_region(layout: dict, address: int) -> dict:
+    """Find the region in a layout containing the given address, or None when no region contains it."""
+    return next((region for region in layout["regions"]
+                 if region["address"] <= address < region["address"] + region["size"]), None)
+
+
+def validate_image_size(layout: dict, address: int, size: int):
+    """
+    Validate that an image of the given size written at the given address fits in a writable region of the layout.
+
+    >>> layout = parse_dfuse_layout("@Internal Flash  /0x08000000/512*0004Kg")
+    >>> validate_image_size(layout, 0x08000000, 2 * 1024 * 1024)
+    >>> validate_image_size(layout, 0x08000000, 2 * 1024 * 1024 + 1)
+    Traceback (most recent call last):
+    ...
+    ValueError: image of 2097153 bytes at 0x8000000 exceeds Internal Flash region 0x8000000-0x8200000.
+    """
+    region = find_layout_region(layout, address)
+    if not region:
+        raise ValueError(f"address {address:#x} is not in {layout['name']}.")
+    end = region["address"] + region["size"]
+    if address + size > end:
+        raise ValueError(f"image of {size} bytes at {address:#x} exceeds {layout['name']} region "
+                         f"{region['address']:#x}-{end:#x}.")
+    if not all(_properties(group) & dfuse_writable for group in region["sectors"]):
+        raise ValueError(f"{layout['name']} region at {region['address']:#x} is not writable.")
+
+
+def changed_sectors(region: dict, address: int, image: bytes, previous: bytes) -> list[tuple[int, int]]:
+    """
+    Find the sectors where an image written at `address` differs from the previous image at the same address.
+
+    The result is a list of (offset, length) runs relative to the start of the image, with adjacent changed sectors
+    merged into one run. Sectors beyond the end of the previous image are always changed.
+
+    >>> region = {"address": 0, "sectors": [{"count": 4, "size": 4}]}
+    >>> changed_sectors(region, 0, b"aaaabbbbccccdddd", b"aaaabbbbccccdddd")
+    []
+    >>> changed_sectors(region, 0, b"aaaaXbbbccccdddX", b"aaaabbbbccccdddd")
+    [(4, 4), (12, 4)]
+    >>> changed_sectors(region, 0, b"aaaaXbbbXcccdd", b"aaaabbbbcccc")
+    [(4, 10)]
+    """
+    runs = []
+    end = address + len(image)
+    for sector_address, sector_size in sector_table(region):
+        start = max(sector_address, address) - address
+        stop = min(sector_address + sector_size, end) - address
+        if stop <= start:
+            continue
+        if image[start:stop] == previous[start:stop] and stop <= len(previous):
+            continue
+        if runs and runs[-1][0] + runs[-1][1] == start:
+            runs[-1] = (runs[-1][0], stop - runs[-1][0])
+        else:
+            runs.append((start, stop - start))
+    return runs
+
+
+def merge_runs(runs: list[tuple[int, int]], max_gap: int) -> list[tuple[int, int]]:
+    """
+    Merge (offset, length) runs separated by no more than `max_gap` bytes, so they are written in one transfer.
+
+    >>> merge_runs([(0, 4), (8, 4), (32, 4)], 4)
+    [(0, 12), (32, 4)]
+    >>> merge_runs([(0, 4), (8, 4), (32, 4)], 0)
+    [(0, 4), (8, 4), (32, 4)]
+    """
+    merged = []
+    for offset, length in runs:
+        if merged and offset - (merged[-1][0] + merged[-1][1]) <= max_gap:
+            merged[-1] = (merged[-1][0], offset + length - merged[-1][0])
+        else:
+            merged.append((offset, length))
+    return merged
+
+
 def is_match(needle: dict, haystack: dict) -> bool:
     """
     Determine if haystack contains all the dictionary keys and values in needle.
@@ -97,57 +244,262 @@ def run_command(cmd: str, cmd_args: list[str], timeout: float = None, capture_ou
 
 notecard_r5_dfu_id = {
     "vid": "0483",
-    "pid": "df11",
-    "name": "@Internal Flash  /0x08000000/512*0004Kg"
+    "pid": "df11"
 }
 
+# the firmware is written to the DFU region with this DfuSe layout name that contains `notecard_dfu_address`
+notecard_flash_name = "Internal Flash"
 notecard_dfu_address = "0x8000000"
 dfu_util_cmd = "dfu-util"
 
+# Each dfu-util run costs more than rewriting a few unchanged sectors, so changed runs this close together are merged.
+incremental_merge_gap = 64 * 1024
+# An incremental DFU with more runs, or changing more of the image, than these is done as a full DFU instead.
+incremental_max_runs = 4
+incremental_max_fraction = 0.5
 
-def build_dfu_util_command_args(dfu_list: str, serial_number: str, filename: str) -> list[str]:
-    """Build the command arguments to dfu-util based on the output from `dfu-util -l.`."""
+
+def is_notecard_flash(dfu_region: dict) -> bool:
+    """
+    Determine if a DFU region is the flash the Notecard firmware is written to, from the DfuSe layout in its name.
+
+    >>> is_notecard_flash({"name": "@Internal Flash  /0x08000000/256*0008Kg"})
+    True
+    >>> is_notecard_flash({"name": "@Option Bytes  /0x1FF00000/01*040 e/0x1FF01000/01*040 e"})
+    False
+    >>> is_notecard_flash({"name": "@Internal Flash  /0x10000000/512*0004Kg"})
+    False
+    """
+    try:
+        layout = parse_dfuse_layout(dfu_region.get("name", ""))
+    except ValueError:
+        return False
+    return layout["name"] == notecard_flash_name and \
+        find_layout_region(layout, int(notecard_dfu_address, 16)) is not None
+
+
+def find_notecard_dfu_region(dfu_list: str, serial_number: str) -> dict:
+    """Find the Notecard flash DFU region for the device with the given serial number in the output from `dfu-util -l`."""
     lines = dfu_list.splitlines()
     dfu_regions = parse_dfu_output(lines)
     find = notecard_r5_dfu_id | {"serial": serial_number}
-    found = _find_one_matching(find, dfu_regions)
+    found = _find_one_matching(find, [region for region in dfu_regions if is_notecard_flash(region)])
 
     try:
         if not found:
             raise RuntimeError(
-                f"Cannot find a DFU region matching {find} in {dfu_regions}.")
+                f"Cannot find a DFU region matching {find} with {notecard_flash_name} at {notecard_dfu_address} "
+                f"in {dfu_regions}.")
     except Exception as e:
         print(lines, flush=True)
         raise e
+    return found
+
 
+def build_dfu_util_command_args(dfu_list: str, serial_number: str, filename: str,
+                                address: str = notecard_dfu_address, leave: bool = True) -> list[str]:
+    """Build the command arguments to dfu-util based on the output from `dfu-util -l.`."""
+    found = find_notecard_dfu_region(dfu_list, serial_number)
     devnum = found.get("devnum")
     alt = found.get("alt")
-    addr = notecard_dfu_address
+    # leave instructs the bootloader to exit when done
+    modifiers = ":leave" if leave else ""
 
     cmd_args = [
         "-n", f"{devnum}",
         "-a", f"{alt}",
-        # leave instructs the bootloader to exit when done
-        "-s", f"{addr}:leave",
+        "-s", f"{address}{modifiers}",
         "-D", f"{filename}"
     ]
     return cmd_args
 
 
-def dfu_util(filename: str, serial_number: str, timeout: float):
-    """Perform a DFU against a notecard with the given serial number."""
-    dfu_list = run_command(
-        dfu_util_cmd, ["-l"], capture_output=True, timeout=20)
-    dfu_args = build_dfu_util_command_args(dfu_list, serial_number, filename)
+def build_upload_command_args(dfu_list: str, serial_number: str, filename: str, length: int,
+                              leave: bool = False, address: str = notecard_dfu_address) -> list[str]:
+    """Build the command arguments to dfu-util to read `length` bytes of flash from the device into `filename`."""
+    found = find_notecard_dfu_region(dfu_list, serial_number)
+    devnum = found.get("devnum")
+    alt = found.get("alt")
+    modifiers = ":leave" if leave else ""
 
-    # Now do the transfer, sending output to stdout
+    cmd_args = [
+        "-n", f"{devnum}",
+        "-a", f"{alt}",
+        "-s", f"{address}{modifiers}:{length}",
+        "-U", f"{filename}"
+    ]
+    return cmd_args
+
+
+def build_leave_dfu_command_args(dfu_list: str, serial_number: str, filename: str) -> list[str]:
+    """Build the command arguments to dfu-util to exit the bootloader without flashing, by reading a few bytes into `filename`."""
+    return build_upload_command_args(dfu_list, serial_number, filename, 4, leave=True)
+
+
+def _firmware_version(filename: str) -> str:
+    """Retrieve the firmware version from the `.json` descriptor saved alongside the firmware, if there is one."""
+    try:
+        with open(f"{filename}.json", "rb") as json_file:
+            return json.loads(json_file.read()).get("firmware", {}).get("version")
+    except (OSError, ValueError):
+        return None
+
+
+def _find_image_by_md5(directory: str, md5: str) -> str:
+    """Find a firmware file in the directory whose `.json` descriptor and content have the given MD5."""
+    from notecard_firmware_get import file_md5
+    for entry in os.listdir(directory or "."):
+        if not entry.endswith(".json"):
+            continue
+        image = os.path.join(directory, entry[:-len(".json")])
+        try:
+            with open(os.path.join(directory, entry), "rb") as json_file:
+                descriptor_md5 = json.loads(json_file.read()).get("md5")
+        except (OSError, ValueError, AttributeError):
+            continue
+        if descriptor_md5 == md5 and file_md5(image) == md5:
+            return image
+    return None
+
+
+def _previous_image(dfu_list: str, serial_number: str, filename: str, length: int, previous: str = None,
+                    ledger: notecard_ledger.Ledger = None) -> bytes:
+    """
+    Retrieve the image currently on the device, for an incremental DFU.
+
+    The image is taken from the `previous` file when given, else from a file alongside `filename` matching the MD5
+    last recorded in the ledger by dfu-util, else it is read back from the device.
+    """
+    if not previous and ledger:
+        # only entries recorded by dfu-util describe the flash of the device with this USB serial number
+        entry = ledger.get(serial_number)
+        if entry and entry["md5"] and entry["method"] == "dfu-util":
+            previous = _find_image_by_md5(os.path.dirname(filename), entry["md5"])
+    if previous:
+        print(f"Comparing with previous image {previous}.", flush=True)
+        with open(previous, "rb") as f:
+            return f.read()
+
+    print(f"Reading back {length} bytes from device {serial_number}.", flush=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        read_back = os.path.join(tmp, "previous.bin")
+        upload_args = build_upload_command_args(dfu_list, serial_number, read_back, length)
+        run_command(dfu_util_cmd, upload_args, capture_output=True, timeout=60 * 5)
+        with open(read_back, "rb") as f:
+            return f.read()
+
+
+def _read_flash(dfu_list: str, serial_number: str, tmp: str, address: int, length: int) -> bytes:
+    """Read `length` bytes of flash from the device at `address`, using the temporary directory `tmp`."""
+    read_back = os.path.join(tmp, f"read-{address:x}-{length}.bin")
+    upload_args = build_upload_command_args(dfu_list, serial_number, read_back, length, address=hex(address))
+    run_command(dfu_util_cmd, upload_args, capture_output=True, timeout=60 * 5)
+    with open(read_back, "rb") as f:
+        return f.read()
+
+
+def _dfu_util_full(dfu_list: str, serial_number: str, filename: str, timeout: float):
+    """Write the whole image, then exit the bootloader."""
+    dfu_args = build_dfu_util_command_args(dfu_list, serial_number, filename)
     run_command(dfu_util_cmd, dfu_args, capture_output=False, timeout=timeout)
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(
-        description='Updates Notecard firmware using dfu-util')
+def _dfu_util_incremental(dfu_list: str, serial_number: str, filename: str, layout: dict, previous_image: bytes,
+                          timeout: float):
+    """
+    Write only the sectors of the image that differ from the previous image, then exit the bootloader.
+
+    Nearby changed sectors are merged into one transfer. The whole image is then read back and verified, since the
+    previous image may not be what the device holds. A full DFU is done instead when verification fails, or when the
+    changes are too many or too scattered for an incremental DFU to be faster.
+    """
+    address = int(notecard_dfu_address, 16)
+    region = find_layout_region(layout, address)
+    with open(filename, "rb") as f:
+        image = f.read()
+    runs = merge_runs(changed_sectors(region, address, image, previous_image), incremental_merge_gap)
+    changed = sum(length for _, length in runs)
+
+    if len(runs) > incremental_max_runs or changed > len(image) * incremental_max_fraction:
+        print(f"Incremental DFU would write {changed} of {len(image)} bytes in {len(runs)} runs. "
+              f"Performing a full DFU.", flush=True)
+        _dfu_util_full(dfu_list, serial_number, filename, timeout)
+        return
+
+    print(f"Incremental DFU: writing {changed} of {len(image)} bytes in {len(runs)} runs.", flush=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, (offset, length) in enumerate(runs):
+            part = os.path.join(tmp, f"part{i}.bin")
+            with open(part, "wb") as f:
+                f.write(image[offset:offset + length])
+            dfu_args = build_dfu_util_command_args(dfu_list, serial_number, part, address=hex(address + offset),
+                                                   leave=False)
+            run_command(dfu_util_cmd, dfu_args, capture_output=False, timeout=timeout)
+
+        # verify before leaving the bootloader, since the device cannot be read once it has left
+        if _read_flash(dfu_list, serial_number, tmp, address, len(image)) != image:
+            print(f"Flash on device {serial_number} does not match {filename} after incremental DFU. "
+                  f"Performing a full DFU.", flush=True)
+            _dfu_util_full(dfu_list, serial_number, filename, timeout)
+            return
+
+        leave_args = build_leave_dfu_command_args(dfu_list, serial_number, os.path.join(tmp, "leave.bin"))
+        run_command(dfu_util_cmd, leave_args, capture_output=True, timeout=20)
+
+
+def dfu_util(filename: str, serial_number: str, timeout: float, ledger: notecard_ledger.Ledger = None,
+             incremental: bool = False, previous: str = None) -> bool:
+    """
+    Perform a DFU against a notecard with the given serial number.
+
+    The image size is first validated against the device's DfuSe flash layout.
+
+    When a ledger is given, the DFU is skipped if the ledger shows the device was last flashed with the same firmware,
+    and the bootloader is exited instead. Successful updates are recorded in the ledger.
 
+    When incremental, only the flash sectors that differ from the previous image are erased and written, and the
+    whole image is verified by reading it back. The previous image is the `previous` file, the image last recorded in the ledger
+    by dfu-util, or else is read back from the device.
+
+    Returns True when the device was flashed, False when it was skipped.
+    """
+    dfu_list = run_command(
+        dfu_util_cmd, ["-l"], capture_output=True, timeout=20)
+    dfu_args = build_dfu_util_command_args(dfu_list, serial_number, filename)
+    layout = parse_dfuse_layout(find_notecard_dfu_region(dfu_list, serial_number)["name"])
+    size = os.path.getsize(filename)
+    validate_image_size(layout, int(notecard_dfu_address, 16), size)
+
+    md5 = None
+    if ledger:
+        from notecard_firmware_get import file_md5
+        md5 = file_md5(filename)
+        if ledger.is_flashed(serial_number, md5=md5, method="dfu-util"):
+            print(f"Skipping DFU. Device {serial_number} already flashed with {filename}, md5 {md5}.", flush=True)
+            with tempfile.TemporaryDirectory() as tmp:
+                leave_args = build_leave_dfu_command_args(dfu_list, serial_number, os.path.join(tmp, "leave.bin"))
+                run_command(dfu_util_cmd, leave_args, capture_output=True, timeout=20)
+            return False
+
+    previous_image = _previous_image(dfu_list, serial_number, filename, size, previous, ledger) if incremental else None
+    if ledger:
+        # the content of the flash is unknown until the transfer succeeds
+        ledger.forget(serial_number)
+
+    if incremental:
+        _dfu_util_incremental(dfu_list, serial_number, filename, layout, previous_image, timeout)
+    else:
+        # Now do the transfer, sending output to stdout
+        run_command(dfu_util_cmd, dfu_args, capture_output=False, timeout=timeout)
+
+    if ledger:
+        ledger.record(serial_number, name=os.path.basename(filename), md5=md5,
+                      version=_firmware_version(filename), method="dfu-util")
+    return True
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Add the command-line arguments for `dfu_util()` to the given parser."""
     # parser.add_argument(
     #     '--no-reset',
     #     required=False,
@@ -160,6 +512,7 @@ if __name__ == '__main__':
         '-t',
         '--timeout',
         required=False,
+        type=float,
         default=60 * 5,
         help='How long, in seconds, to wait for the DFU to finish.')
 
@@ -172,5 +525,37 @@ if __name__ == '__main__':
         'filename',
         help='The name of the local file to transfer.')
 
-    args = parser.parse_args()
-    dfu_util(**vars(args))
+    parser.add_argument(
+        '-i',
+        '--incremental',
+        required=False,
+        action='store_true',
+        default=False,
+        help='Only erase and write the flash sectors that differ from the image currently on the device.')
+
+    parser.add_argument(
+        '--previous',
+        required=False,
+        default=None,
+        help='The image currently on the device, for an incremental DFU. Defaults to the image recorded in the '
+             'ledger, or else the image is read back from the device.')
+
+    notecard_ledger.add_ledger_argument(parser)
+
+
+def main(args):
+    """Perform a DFU using the parsed command-line arguments."""
+    options = {"filename": args.filename, "serial_number": args.serial_number, "timeout": args.timeout,
+               "incremental": args.incremental, "previous": args.previous}
+    if not args.ledger:
+        dfu_util(**options)
+        return
+    with notecard_ledger.Ledger(args.ledger) as ledger:
+        dfu_util(**options, ledger=ledger)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Updates Notecard firmware using dfu-util')
+    add_arguments(parser)
+    main(parser.parse_args())
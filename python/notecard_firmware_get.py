@@ -4,7 +4,6 @@ import argparse
 import base64
 import hashlib
 import json
-import requests
 import os
 import notecard_firmware_query
 
@@ -15,8 +14,9 @@ def _assert_property(json, name):
     return json[name]
 
 
-def _get_notecard_firmware(filename, existing_md5=None) -> (dict, str):
-    url = 'https://api.notefile.net/req'
+def _get_notecard_firmware(filename, existing_md5=None, notehub=notecard_firmware_query.notehub_default) -> (dict, str):
+    import requests
+    url = f'{notehub}/req'
     headers = {}  # {'Authorization': f'Bearer {access_token}'}
     req_json = {"req": "hub.upload.get", "type": "notecard", "name": filename}
     response = requests.get(url, headers=headers, json=req_json)
@@ -38,7 +38,7 @@ def _get_notecard_firmware(filename, existing_md5=None) -> (dict, str):
     if existing_md5:
         # since the payload isn't retrieved, the MD5 given is for a zero-byte checksum, d41d8cd98f00b204e9800998ecf8427e
         # so we use the query API to get teh actual MD5
-        selected = notecard_firmware_query.find_firmware(name=filename, allow=True)
+        selected = notecard_firmware_query.find_firmware(name=filename, allow=True, notehub=notehub)
         expected_md5 = _assert_property(selected, "md5")
         if existing_md5 == expected_md5:
             print("File already downloaded. Skipping download.")
@@ -104,31 +104,47 @@ def _save(filename: str, firmware_json, payload_bytes):
         json_file.write(json.dumps(firmware_json).encode("utf-8"))
 
 
-def file_md5(filename: str) -> str:
-    """Compute the MD5 of a file."""
-    return hashlib.md5(open(filename, 'rb').read()).hexdigest() if os.path.isfile(filename) else None
+def file_md5(filename: str, chunk_size: int = 1024 * 1024) -> str:
+    """Compute the MD5 of a file, reading it in chunks, or None when there is no such file."""
+    if not os.path.isfile(filename):
+        return None
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
 
 
-def download_firmware(filename: str):
+def download_firmware(filename: str, notehub=notecard_firmware_query.notehub_default, path: str = None):
     """
     Download firmware from Notehub with the given filename.
 
-    The same filename is used to write out the firmware file.
-    The firmware json descriptor is written to a `.json` file.
+    The firmware is written to `path`, which defaults to the same filename.
+    The firmware json descriptor is written to a `.json` file alongside it.
     """
-    existing_md5 = file_md5(filename)
-    firmware_json, payload = _get_notecard_firmware(filename, existing_md5)
+    path = path or filename
+    existing_md5 = file_md5(path)
+    firmware_json, payload = _get_notecard_firmware(filename, existing_md5, notehub)
     payload_bytes = _validate(firmware_json, payload, existing_md5)
-    _save(filename, firmware_json, payload_bytes)
+    _save(path, firmware_json, payload_bytes)
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(
-        description='Retrieve available firmware from Notehub')
-
+def add_arguments(parser: argparse.ArgumentParser):
+    """Add the command-line arguments for retrieving firmware to the given parser."""
     parser.add_argument(
         "filename",
         help='The filename of the firmware to retrieve.')
 
-    args = parser.parse_args()
-    download_firmware(args.filename)
+    notecard_firmware_query.add_notehub_argument(parser)
+
+
+def main(args):
+    """Download firmware from Notehub using the parsed command-line arguments."""
+    download_firmware(args.filename, notehub=args.notehub)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Retrieve available firmware from Notehub')
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,340 @@
+"""
+A LAN mirror of Notehub Notecard firmware.
+
+The mirror implements the subset of the Notehub `/req` API used by `notecard_firmware_query` and
+`notecard_firmware_get`, namely `hub.upload.query` and `hub.upload.get`, so clients only need to point their Notehub
+URL at the mirror, e.g. `--notehub http://mirror:8080` or `NOTEHUB_URL=http://mirror:8080`.
+
+Firmware is served from a local cache directory, using the same layout as `notecard_firmware_get`: the firmware
+file and a `.json` sidecar with the firmware descriptor. Cached files are verified against the MD5 and length in
+the sidecar before they are served. Concurrent requests for firmware that is not cached are coalesced into a single
+upstream fetch.
+
+The firmware list is reused for a short time, and while upstream is unavailable.
+
+`hub.upload.get` accepts an optional `offset` along with `length` to retrieve part of a file. The raw file is also
+available at `/uploads/<name>`, which honors HTTP `Range` headers.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+import notecard_firmware_get
+import notecard_firmware_query
+
+uploads_path = "/uploads/"
+chunk_size = 64 * 1024
+
+
+def parse_range(header: str, size: int) -> (int, int):
+    """
+    Parse an HTTP `Range` header for a single byte range, returning the start offset and the length.
+
+    >>> parse_range("bytes=0-99", 1000)
+    (0, 100)
+    >>> parse_range("bytes=900-", 1000)
+    (900, 100)
+    >>> parse_range("bytes=-100", 1000)
+    (900, 100)
+    >>> parse_range("bytes=990-2000", 1000)
+    (990, 10)
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        raise ValueError(f"unsupported range {header}")
+    first, _, last = spec.strip().partition("-")
+    if not first:
+        start = max(size - int(last), 0)
+        end = size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError(f"range {header} not satisfiable for size {size}")
+    return start, end - start + 1
+
+
+class FirmwareMirror:
+    """
+    A cache of Notehub firmware, backed by a local directory and filled from an upstream Notehub on demand.
+
+    `query_ttl` is how long, in seconds, the firmware list from upstream is reused before it is fetched again.
+    """
+
+    def __init__(self, directory: str, upstream=notecard_firmware_query.notehub_default, query_ttl: float = 60):
+        """Create a mirror caching firmware in `directory`."""
+        self.directory = directory
+        self.upstream = upstream
+        self.query_ttl = query_ttl
+        self.upstream_fetches = 0
+        self._lock = threading.Lock()
+        self._inflight: dict[str, Future] = {}
+        self._verified: dict[str, tuple] = {}
+        self._queries: dict[bool, tuple] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        """Determine the path of the named firmware in the cache."""
+        if not name or name.startswith(".") or "/" in name or "\\" in name:
+            raise ValueError(f"invalid firmware name {name!r}")
+        return os.path.join(self.directory, name)
+
+    def _coalesce(self, key: str, fetch):
+        """Call `fetch`, unless a call for the same key is already in progress, in which case its result is shared."""
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+        if owner:
+            try:
+                future.set_result(fetch())
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+        return future.result()
+
+    def _cached(self, name: str):
+        """Retrieve the firmware descriptor of a verified cached file, or None when not cached or not valid."""
+        filename = self.path(name)
+        try:
+            stat = os.stat(filename)
+            with open(f"{filename}.json", "rb") as json_file:
+                firmware_json = json.loads(json_file.read())
+        except (OSError, ValueError):
+            return None
+
+        signature = (stat.st_size, stat.st_mtime_ns, firmware_json.get("md5"))
+        if self._verified.get(name) != signature:
+            if stat.st_size != firmware_json.get("length") or \
+                    notecard_firmware_get.file_md5(filename) != firmware_json.get("md5"):
+                return None
+            self._verified[name] = signature
+        return firmware_json
+
+    def _fetch_upstream(self, name: str) -> dict:
+        """Download the named firmware from upstream into the cache, returning the firmware descriptor."""
+        self.upstream_fetches += 1
+        try:
+            firmware_json, payload = notecard_firmware_get._get_notecard_firmware(name, notehub=self.upstream)
+            payload_bytes = notecard_firmware_get._validate(firmware_json, payload, None)
+        except Exception as e:
+            raise RuntimeError(f"unable to fetch {name} from {self.upstream}") from e
+        # write to a temporary name so that a partially written file is never served
+        filename = self.path(name)
+        partial = f"{filename}.{threading.get_ident()}.partial"
+        notecard_firmware_get._save(partial, firmware_json, payload_bytes)
+        os.replace(f"{partial}.json", f"{filename}.json")
+        os.replace(partial, filename)
+        return firmware_json
+
+    def firmware(self, name: str) -> dict:
+        """Retrieve the descriptor of the named firmware, fetching it from upstream when it is not in the cache."""
+        return self._cached(name) or self._coalesce(name, lambda: self._cached(name) or self._fetch_upstream(name))
+
+    def _query_upstream(self, allow: bool) -> list:
+        return notecard_firmware_query.list_notecard_firmware(allow=allow, notehub=self.upstream)
+
+    def list_firmware(self, allow: bool) -> list:
+        """
+        List the firmware available upstream, reusing a recent result when there is one.
+
+        When upstream is unavailable, the last result is used, however old, so cached firmware can still be found.
+        """
+        allow = bool(allow)
+        cached = self._queries.get(allow)
+        if cached and time.monotonic() - cached[0] < self.query_ttl:
+            return cached[1]
+
+        def fetch():
+            try:
+                uploads = self._query_upstream(allow)
+            except Exception:
+                if cached:
+                    return cached[1]
+                raise
+            self._queries[allow] = (time.monotonic(), uploads)
+            return uploads
+
+        return self._coalesce(f"query:{allow}", fetch)
+
+    def read(self, name: str, offset: int = 0, length: int = None) -> bytes:
+        """Read part or all of the named firmware."""
+        firmware_json = self.firmware(name)
+        total = firmware_json["length"]
+        if offset < 0 or offset > total:
+            raise ValueError(f"offset {offset} outside of firmware length {total}")
+        length = total - offset if length is None else min(length, total - offset)
+        with open(self.path(name), "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def request(self, req: dict) -> dict:
+        """Handle a Notehub request, returning the response."""
+        match req.get("req"):
+            case "hub.upload.query":
+                return {"uploads": self.list_firmware(req.get("allow", False))}
+            case "hub.upload.get":
+                name = req.get("name")
+                firmware_json = self.firmware(name)
+                if "length" not in req:
+                    return {"body": firmware_json}
+                offset = req.get("offset", 0)
+                payload = self.read(name, offset, req["length"])
+                response = {"body": firmware_json,
+                            "payload": base64.b64encode(payload).decode("ascii"),
+                            "md5": hashlib.md5(payload).hexdigest(),
+                            "length": len(payload)}
+                if offset:
+                    response["offset"] = offset
+                return response
+            case other:
+                raise ValueError(f"unsupported request {other}")
+
+
+class _LimitedReader:
+    """Wraps a file so that at most `remaining` bytes are read from it."""
+
+    def __init__(self, f, remaining: int):
+        self.f = f
+        self.remaining = remaining
+
+    def read(self, size: int = -1) -> bytes:
+        size = self.remaining if size < 0 else min(size, self.remaining)
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+class MirrorRequestHandler(BaseHTTPRequestHandler):
+    """Serves Notehub requests and raw firmware files from the server's `FirmwareMirror`."""
+
+    protocol_version = "HTTP/1.1"
+
+    def _send_json(self, status: int, response: dict):
+        content = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _handle_req(self):
+        try:
+            content_length = int(self.headers.get("Content-Length", 0))
+            req = json.loads(self.rfile.read(content_length) or b"{}")
+            self._send_json(200, self.server.mirror.request(req))
+        except (ValueError, KeyError) as e:
+            self._send_json(400, {"err": str(e)})
+        except Exception as e:
+            self._send_json(502, {"err": f"upstream error: {e}"})
+
+    def _handle_upload(self):
+        mirror: FirmwareMirror = self.server.mirror
+        name = unquote(self.path[len(uploads_path):])
+        range_header = self.headers.get("Range")
+        try:
+            total = mirror.firmware(name)["length"]
+            offset, length = 0, total
+            if range_header:
+                offset, length = parse_range(range_header, total)
+        except ValueError as e:
+            self._send_json(416 if range_header else 400, {"err": str(e)})
+            return
+        except Exception as e:
+            self._send_json(502, {"err": f"upstream error: {e}"})
+            return
+
+        self.send_response(206 if range_header else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        if range_header:
+            self.send_header("Content-Range", f"bytes {offset}-{offset + length - 1}/{total}")
+        self.end_headers()
+        with open(mirror.path(name), "rb") as f:
+            f.seek(offset)
+            shutil.copyfileobj(_LimitedReader(f, length), self.wfile, chunk_size)
+
+    def do_GET(self):
+        """Handle a GET, which is either a Notehub request or a raw firmware download."""
+        if self.path.startswith(uploads_path):
+            self._handle_upload()
+        else:
+            self._handle_req()
+
+    def do_POST(self):
+        """Handle a POST, which is a Notehub request."""
+        self._handle_req()
+
+
+def create_server(mirror: FirmwareMirror, host: str = "", port: int = 8080) -> ThreadingHTTPServer:
+    """Create an HTTP server for the mirror. Call `serve_forever()` on the result to start serving."""
+    server = ThreadingHTTPServer((host, port), MirrorRequestHandler)
+    server.mirror = mirror
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Add the command-line arguments for running a firmware mirror to the given parser."""
+    parser.add_argument(
+        '-d',
+        '--directory',
+        required=True,
+        help='The directory where firmware is cached.')
+
+    parser.add_argument(
+        '--host',
+        required=False,
+        default="",
+        help='The address to listen on. Defaults to all interfaces.')
+
+    parser.add_argument(
+        '-p',
+        '--port',
+        required=False,
+        type=int,
+        default=8080,
+        help='The port to listen on.')
+
+    parser.add_argument(
+        '-u',
+        '--upstream',
+        required=False,
+        default=notecard_firmware_query.notehub_default,
+        help='The Notehub URL firmware is fetched from when not cached.')
+
+    parser.add_argument(
+        '--query-ttl',
+        required=False,
+        type=float,
+        default=60,
+        help='How long, in seconds, the firmware list from upstream is reused.')
+
+
+def main(args):
+    """Run a firmware mirror using the parsed command-line arguments."""
+    mirror = FirmwareMirror(args.directory, upstream=args.upstream, query_ttl=args.query_ttl)
+    server = create_server(mirror, args.host, args.port)
+    print(f"Serving firmware from {args.directory} on port {server.server_port}, upstream {args.upstream}",
+          flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve Notehub firmware from a local cache.')
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,317 @@
+"""
+Resolve, download and flash Notecard firmware for many devices as a pipeline.
+
+Each job is a firmware version spec and the serial number of the device to flash with dfu-util. The jobs flow through
+three stages connected by bounded queues:
+
+* resolve - find the firmware on Notehub matching the version spec
+* download - download and validate the firmware
+* flash - flash the firmware to the device using dfu-util
+
+Each stage has its own worker threads, so devices are flashed as soon as their firmware is verified, while downloads
+for other jobs continue. Firmware shared by several jobs is resolved and downloaded once.
+"""
+
+import argparse
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import notecard_dfu_util
+import notecard_firmware_get
+import notecard_firmware_query
+import notecard_ledger
+
+# marks the end of the jobs on a queue
+_done = object()
+
+
+def parse_job(spec: str) -> dict:
+    """
+    Parse a job given as `<version>:<serial>`.
+
+    >>> parse_job("5.1.1:205B3875594D")
+    {'version': '5.1.1', 'serial': '205B3875594D'}
+    """
+    version, sep, serial = spec.strip().partition(":")
+    if not sep or not serial:
+        raise ValueError(f"job {spec!r} is not of the form <version>:<serial>")
+    return {"version": version, "serial": serial}
+
+
+def read_jobs(filename: str) -> list[dict]:
+    """Read jobs from a file, one `<version>:<serial>` job per line. Blank lines and lines starting with '#' are ignored."""
+    with open(filename) as f:
+        return [parse_job(line) for line in f if line.strip() and not line.strip().startswith("#")]
+
+
+class _Once:
+    """Calls a function at most once per key, sharing the result, or the exception raised, with every caller."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures: dict[object, Future] = {}
+
+    def __call__(self, key, func):
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = Future()
+        if owner:
+            try:
+                future.set_result(func())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+
+class Stage:
+    """
+    A pipeline stage, which applies `func` to each job using a number of worker threads.
+
+    `func` updates the job dict in place. A job is passed to the next stage when `func` returns, and is finished with
+    an `error` when `func` raises an exception.
+    """
+
+    def __init__(self, name: str, func, workers: int = 1):
+        """Create a stage with the given name, job function and number of workers."""
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.processed = 0
+        self.failed = 0
+        self.busy_secs = 0.0
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def utilization(self, elapsed_secs: float) -> float:
+        """Determine the fraction of the available worker time spent processing jobs."""
+        return self.busy_secs / (elapsed_secs * self.workers) if elapsed_secs else 0.0
+
+
+class Pipeline:
+    """Runs jobs through a sequence of stages connected by bounded queues."""
+
+    def __init__(self, stages: list[Stage], queue_size: int = 2):
+        """Create a pipeline of the given stages. `queue_size` bounds the number of jobs waiting between stages."""
+        self.stages = stages
+        self.queue_size = queue_size
+        self.elapsed_secs = 0.0
+
+    def _work(self, stage: Stage, inbox: queue.Queue, outbox: queue.Queue, next_workers: int, results: list):
+        while (job := inbox.get()) is not _done:
+            started = time.monotonic()
+            try:
+                stage.func(job)
+                failed = False
+            except Exception as e:
+                job["error"] = f"{stage.name}: {e}"
+                failed = True
+            with stage._lock:
+                stage.busy_secs += time.monotonic() - started
+                stage.processed += 1
+                stage.failed += failed
+            if outbox and not failed:
+                outbox.put(job)
+            else:
+                results.append(job)
+
+        with stage._lock:
+            stage._running -= 1
+            last = not stage._running
+        if last and outbox:
+            for _ in range(next_workers):
+                outbox.put(_done)
+
+    def run(self, jobs: list[dict]) -> list[dict]:
+        """Run the jobs through the pipeline, returning the jobs in the order they finished."""
+        results = []
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        threads = []
+        start = time.monotonic()
+        for i, stage in enumerate(self.stages):
+            last_stage = i + 1 == len(self.stages)
+            outbox = None if last_stage else queues[i + 1]
+            next_workers = 0 if last_stage else self.stages[i + 1].workers
+            stage._running = stage.workers
+            for _ in range(stage.workers):
+                thread = threading.Thread(target=self._work, name=f"{stage.name}-worker",
+                                          args=(stage, queues[i], outbox, next_workers, results), daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        for job in jobs:
+            queues[0].put(job)
+        for _ in range(self.stages[0].workers):
+            queues[0].put(_done)
+        for thread in threads:
+            thread.join()
+        self.elapsed_secs = time.monotonic() - start
+        return results
+
+    def report(self) -> str:
+        """Describe the work done and utilization of each stage."""
+        lines = [f"pipeline completed in {self.elapsed_secs:.1f}s"]
+        for stage in self.stages:
+            lines.append(f"{stage.name}: {stage.processed} jobs, {stage.failed} failed, {stage.workers} workers, "
+                         f"busy {stage.busy_secs:.1f}s, utilization {stage.utilization(self.elapsed_secs):.0%}")
+        return "\n".join(lines)
+
+
+def firmware_stages(directory: str, allow: bool = False, target: str = None,
+                    notehub=notecard_firmware_query.notehub_default, timeout: float = 60 * 5,
+                    download_workers: int = 2, flash_workers: int = 1,
+                    ledger: notecard_ledger.Ledger = None, incremental: bool = False) -> list[Stage]:
+    """
+    Create the resolve, download and flash stages, writing firmware to `directory`, which is created if needed.
+
+    When a ledger is given, devices it shows are already flashed with the firmware are skipped.
+    When incremental, only the flash sectors that changed are written to each device.
+    """
+    os.makedirs(directory, exist_ok=True)
+    resolved = _Once()
+    downloaded = _Once()
+    device_locks: dict[str, threading.Lock] = {}
+    device_locks_lock = threading.Lock()
+
+    def resolve(job: dict):
+        version = job["version"]
+        job["name"] = resolved(version, lambda: notecard_firmware_query.find_firmware(
+            name=None, allow=allow, version=version, target=target, notehub=notehub)["name"])
+
+    def download(job: dict):
+        name = job["name"]
+        path = os.path.join(directory, name)
+        downloaded(name, lambda: notecard_firmware_get.download_firmware(name, notehub=notehub, path=path))
+        job["path"] = path
+
+    def flash(job: dict):
+        serial = job["serial"]
+        # a device can only be flashed by one job at a time
+        with device_locks_lock:
+            device_lock = device_locks.setdefault(serial, threading.Lock())
+        with device_lock:
+            job["skipped"] = not notecard_dfu_util.dfu_util(job["path"], serial, timeout, ledger=ledger,
+                                                            incremental=incremental)
+
+    return [Stage("resolve", resolve),
+            Stage("download", download, download_workers),
+            Stage("flash", flash, flash_workers)]
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Add the command-line arguments for the firmware pipeline to the given parser."""
+    parser.add_argument(
+        'jobs',
+        nargs='*',
+        help='The jobs to run, each given as <version>:<serial>.')
+
+    parser.add_argument(
+        '-f',
+        '--jobs-file',
+        required=False,
+        help='A file listing jobs, one <version>:<serial> job per line.')
+
+    parser.add_argument(
+        '-d',
+        '--directory',
+        required=False,
+        default=".",
+        help='The directory firmware is downloaded to.')
+
+    parser.add_argument(
+        '-t',
+        '--target',
+        required=False,
+        default=None,
+        help='The target architecture.')
+
+    parser.add_argument(
+        '-a',
+        '--allow',
+        required=False,
+        action='store_true',
+        default=False,
+        help='Allow use of unpublished firmware.')
+
+    parser.add_argument(
+        '--timeout',
+        required=False,
+        type=float,
+        default=60 * 5,
+        help='How long, in seconds, to wait for each DFU to finish.')
+
+    parser.add_argument(
+        '-i',
+        '--incremental',
+        required=False,
+        action='store_true',
+        default=False,
+        help='Only erase and write the flash sectors that differ from the image currently on each device.')
+
+    parser.add_argument(
+        '--download-workers',
+        required=False,
+        type=int,
+        default=2,
+        help='How many firmware downloads run at once.')
+
+    parser.add_argument(
+        '--flash-workers',
+        required=False,
+        type=int,
+        default=None,
+        help='How many devices are flashed at once. Defaults to the number of devices.')
+
+    parser.add_argument(
+        '--queue-size',
+        required=False,
+        type=int,
+        default=2,
+        help='How many jobs can wait between stages.')
+
+    notecard_firmware_query.add_notehub_argument(parser)
+    notecard_ledger.add_ledger_argument(parser)
+
+
+def main(args):
+    """Run the firmware pipeline using the parsed command-line arguments."""
+    jobs = [parse_job(spec) for spec in args.jobs]
+    if args.jobs_file:
+        jobs += read_jobs(args.jobs_file)
+    if not jobs:
+        raise ValueError("No jobs given.")
+
+    flash_workers = args.flash_workers or len({job["serial"] for job in jobs})
+    ledger = notecard_ledger.Ledger(args.ledger) if args.ledger else None
+    stages = firmware_stages(args.directory, allow=args.allow, target=args.target, notehub=args.notehub,
+                             timeout=args.timeout, download_workers=args.download_workers,
+                             flash_workers=flash_workers, ledger=ledger, incremental=args.incremental)
+    pipeline = Pipeline(stages, queue_size=args.queue_size)
+    try:
+        results = pipeline.run(jobs)
+    finally:
+        if ledger:
+            ledger.close()
+
+    for job in results:
+        if job.get("error"):
+            outcome = f"failed, {job['error']}"
+        else:
+            outcome = "skipped, already flashed" if job.get("skipped") else "flashed"
+        print(f"{job['version']}:{job['serial']} {job.get('name', '')} {outcome}", flush=True)
+    print(pipeline.report(), flush=True)
+
+    failed = [job for job in results if job.get("error")]
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(results)} jobs failed.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Resolve, download and flash Notecard firmware for many devices concurrently.')
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -15,13 +15,14 @@ The main function is find_firmware()
 import argparse
 import functools
 import json
-import requests
+import os
 
 notehub_default = "https://api.notefile.net"
 
 
 def query_notecard_firmware(filename, notehub=notehub_default):
     """Query Notehub for a specific firmware, identified by name."""
+    import requests
     url = f'{notehub}/req'
     headers = {}  # {'Authorization': f'Bearer {access_token}'}
     req_json = {"req": "hub.upload.get", "allow": True,
@@ -37,6 +38,7 @@ def query_notecard_firmware(filename, notehub=notehub_default):
 
 def list_notecard_firmware(allow: bool, notehub=notehub_default):
     """Query Notehub for all published firmware, and optionally unpublished firmware."""
+    import requests
     url = f'{notehub}/req'
     headers = {}  # {'Authorization': f'Bearer {access_token}'}
     req_json = {"req": "hub.upload.query", "type": "notecard", "allow": allow}
@@ -153,14 +155,14 @@ def sort_firmware(firmware: list):
     return firmware
 
 
-def find_firmware(name: str, allow: bool, version: str = None, target: str = None):
+def find_firmware(name: str, allow: bool, version: str = None, target: str = None, notehub=notehub_default):
     """
     Find firmware on Notehub that matches the given criteria.
 
     When as_json is false, the firmware name found is returned as a string. Otherwise the json
     firmware descriptor is returned, also as a string.
     """
-    firmware = list_notecard_firmware(allow=allow)
+    firmware = list_notecard_firmware(allow=allow, notehub=notehub)
     firmware = _filter_firmware(firmware, version, target, name)
     sort_firmware(firmware)
     if not len(firmware):
@@ -170,10 +172,8 @@ def find_firmware(name: str, allow: bool, version: str = None, target: str = Non
     return selected
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(
-        description='Query available firmware from Notehub.')
-
+def add_arguments(parser: argparse.ArgumentParser):
+    """Add the command-line arguments for querying firmware to the given parser."""
     parser.add_argument(
         '-n',
         '--name',
@@ -211,11 +211,32 @@ if __name__ == '__main__':
         default=False,
         help='Output detailed info of the firmware identified as json.')
 
-    args = parser.parse_args()
+    add_notehub_argument(parser)
+
+
+def add_notehub_argument(parser: argparse.ArgumentParser):
+    """Add the `--notehub` argument, which defaults to the `NOTEHUB_URL` environment variable when set."""
+    parser.add_argument(
+        '--notehub',
+        required=False,
+        default=os.environ.get("NOTEHUB_URL", notehub_default),
+        help='The Notehub URL to use, such as a firmware mirror. Defaults to $NOTEHUB_URL or %(default)s.')
+
+
+def main(args):
+    """Query Notehub for firmware and print the result."""
     selected = find_firmware(name=args.name,
                              allow=args.allow,
                              target=args.target,
-                             version=args.version)
+                             version=args.version,
+                             notehub=args.notehub)
 
     output = json.dumps(selected) if args.json else selected["name"]
     print(output, flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Query available firmware from Notehub.')
+    add_arguments(parser)
+    main(parser.parse_args())
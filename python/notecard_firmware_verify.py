@@ -0,0 +1,198 @@
+"""
+Verify the integrity of a directory of downloaded firmware.
+
+Each firmware file saved by `notecard_firmware_get`, or cached by `notecard_firmware_mirror`, has a `.json` sidecar
+holding its firmware descriptor. Verification hashes each firmware file and compares the MD5 and length with those
+in the sidecar, and optionally with the Notehub catalog. Files are hashed in parallel in a pool of processes, reading
+each file in chunks through a memory map.
+
+The result is a JSON report listing each firmware file and a summary.
+"""
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import notecard_firmware_query
+
+chunk_size = 1024 * 1024
+
+
+def file_digest(filename: str, chunk_size: int = chunk_size) -> (str, int):
+    """Compute the MD5 and length of a file, reading it in chunks through a memory map."""
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        length = os.fstat(f.fileno()).st_size
+        if length:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, length, chunk_size):
+                        md5.update(view[offset:offset + chunk_size])
+                finally:
+                    view.release()
+    return md5.hexdigest(), length
+
+
+def is_sidecar(filename: str) -> bool:
+    """Determine if a file is a firmware sidecar, a `.json` file holding a descriptor with an MD5 and length."""
+    if not filename.endswith(".json") or filename.endswith(".partial.json"):
+        return False
+    try:
+        with open(filename, "rb") as f:
+            descriptor = json.loads(f.read())
+    except (OSError, ValueError):
+        return False
+    return isinstance(descriptor, dict) and "md5" in descriptor and "length" in descriptor
+
+
+def find_firmware_files(directory: str, recursive: bool = False) -> list[str]:
+    """List the firmware files in the directory, which are those with a sidecar. Other JSON files are ignored."""
+    if recursive:
+        names = [os.path.join(root, name) for root, _, names in os.walk(directory) for name in names]
+    else:
+        names = [os.path.join(directory, name) for name in os.listdir(directory)]
+    return sorted(name[:-len(".json")] for name in names if is_sidecar(name))
+
+
+def _verify_file(filename: str) -> dict:
+    """Verify one firmware file against its sidecar. Runs in a worker process."""
+    result = {"name": os.path.basename(filename), "path": filename}
+    try:
+        with open(f"{filename}.json", "rb") as json_file:
+            descriptor = json.loads(json_file.read())
+        result["expected_md5"] = descriptor.get("md5")
+        result["expected_length"] = descriptor.get("length")
+    except (OSError, ValueError, AttributeError) as e:
+        return result | {"status": "error", "error": f"unreadable sidecar: {e}"}
+
+    try:
+        result["md5"], result["length"] = file_digest(filename)
+    except FileNotFoundError:
+        return result | {"status": "missing"}
+    except OSError as e:
+        return result | {"status": "error", "error": str(e)}
+
+    matches = result["md5"] == result["expected_md5"] and result["length"] == result["expected_length"]
+    result["status"] = "ok" if matches else "mismatch"
+    return result
+
+
+def _compare_catalog(result: dict, catalog: dict):
+    entry = catalog.get(result["name"])
+    if not entry:
+        result["catalog"] = "absent"
+    elif entry.get("md5") == result.get("md5") and entry.get("length") == result.get("length"):
+        result["catalog"] = "ok"
+    else:
+        result["catalog"] = "mismatch"
+        result["catalog_md5"] = entry.get("md5")
+        result["catalog_length"] = entry.get("length")
+        if result["status"] == "ok":
+            result["status"] = "mismatch"
+
+
+def verify_firmware(directory: str, workers: int = None, recursive: bool = False, catalog: list = None) -> dict:
+    """
+    Verify every firmware file in the directory against its sidecar, returning a report.
+
+    `workers` is the number of processes hashing files, which defaults to the number of CPUs.
+    When `catalog` is given, as returned by `hub.upload.query`, files are also compared with the catalog entry of
+    the same name.
+    """
+    start = time.monotonic()
+    filenames = find_firmware_files(directory, recursive)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        files = list(executor.map(_verify_file, filenames))
+
+    if catalog is not None:
+        by_name = {entry["name"]: entry for entry in catalog}
+        for result in files:
+            _compare_catalog(result, by_name)
+
+    elapsed_secs = time.monotonic() - start
+    total_bytes = sum(result.get("length", 0) for result in files)
+    failed = sum(result["status"] != "ok" for result in files)
+    return {
+        "directory": directory,
+        "files": files,
+        "summary": {
+            "files": len(files),
+            "ok": len(files) - failed,
+            "failed": failed,
+            "bytes": total_bytes,
+            "seconds": round(elapsed_secs, 3),
+            "mb_per_sec": round(total_bytes / elapsed_secs / 1e6, 1) if elapsed_secs else None,
+        }
+    }
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Add the command-line arguments for verifying firmware to the given parser."""
+    parser.add_argument(
+        'directory',
+        help='The directory of firmware files and their .json sidecars to verify.')
+
+    parser.add_argument(
+        '-r',
+        '--recursive',
+        required=False,
+        action='store_true',
+        default=False,
+        help='Also verify firmware in subdirectories.')
+
+    parser.add_argument(
+        '-w',
+        '--workers',
+        required=False,
+        type=int,
+        default=None,
+        help='How many processes hash files. Defaults to the number of CPUs.')
+
+    parser.add_argument(
+        '-c',
+        '--catalog',
+        required=False,
+        action='store_true',
+        default=False,
+        help='Also compare each file with the Notehub firmware catalog.')
+
+    parser.add_argument(
+        '-o',
+        '--output',
+        required=False,
+        default=None,
+        help='The file to write the JSON report to. Defaults to stdout.')
+
+    notecard_firmware_query.add_notehub_argument(parser)
+
+
+def main(args):
+    """Verify firmware using the parsed command-line arguments."""
+    catalog = notecard_firmware_query.list_notecard_firmware(allow=True, notehub=args.notehub) if args.catalog else None
+    report = verify_firmware(args.directory, workers=args.workers, recursive=args.recursive, catalog=catalog)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output, flush=True)
+
+    summary = report["summary"]
+    print(f"Verified {summary['files']} files, {summary['bytes']} bytes in {summary['seconds']}s: "
+          f"{summary['ok']} ok, {summary['failed']} failed.", file=sys.stderr, flush=True)
+    if summary["failed"]:
+        raise RuntimeError(f"{summary['failed']} firmware files failed verification.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Verify the integrity of a directory of firmware files.')
+    add_arguments(parser)
+    main(parser.parse_args())
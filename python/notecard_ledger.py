@@ -0,0 +1,158 @@
+"""
+A persistent local ledger of the firmware last flashed to each device.
+
+The ledger is an SQLite database keyed by device serial number. The serial is the identifier available to the update
+method used: the USB serial number reported by `dfu-util -l` for dfu-util updates, or the Notecard device UID
+reported by `card.version` for Notehub DFU. The two identifiers cannot be related to each other, so an entry is only
+valid while a device is always updated by the same method. Each method only trusts entries it recorded itself, and
+a device updated by the other method in the meantime should be removed with `forget()`.
+
+Updates record the firmware name, MD5 and version after a successful flash, so that fleet runs can skip devices that
+are already at the target firmware, and the ledger can be queried for the state of the fleet.
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+
+_schema = """
+CREATE TABLE IF NOT EXISTS devices (
+    serial TEXT PRIMARY KEY,
+    name TEXT,
+    md5 TEXT,
+    version TEXT,
+    method TEXT,
+    flashed_at REAL
+)
+"""
+
+_columns = ["serial", "name", "md5", "version", "method", "flashed_at"]
+
+
+def default_ledger():
+    """Determine the default ledger path from the `NOTECARD_LEDGER` environment variable, if set."""
+    return os.environ.get("NOTECARD_LEDGER")
+
+
+class Ledger:
+    """The firmware last flashed to each device, stored in an SQLite database. Safe to use from multiple threads."""
+
+    def __init__(self, path: str):
+        """Open the ledger at `path`, creating it when it does not exist."""
+        import sqlite3
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(_schema)
+        self._db.commit()
+
+    def close(self):
+        """Close the ledger."""
+        self._db.close()
+
+    def __enter__(self):
+        """Use the ledger as a context manager, which closes it on exit."""
+        return self
+
+    def __exit__(self, *exc):
+        """Close the ledger."""
+        self.close()
+
+    def record(self, serial: str, name: str = None, md5: str = None, version: str = None, method: str = None):
+        """Record that the firmware was successfully flashed to the device with the given serial number."""
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?, ?)",
+                             (serial, name, md5, version, method, time.time()))
+            self._db.commit()
+
+    def forget(self, serial: str):
+        """Remove the device from the ledger, so that it is flashed on the next run."""
+        with self._lock:
+            self._db.execute("DELETE FROM devices WHERE serial = ?", (serial,))
+            self._db.commit()
+
+    def get(self, serial: str) -> dict:
+        """Retrieve the ledger entry for a device, or None when the device has not been flashed."""
+        devices = self.devices(serial=serial)
+        return devices[0] if devices else None
+
+    def devices(self, **criteria) -> list[dict]:
+        """
+        List the ledger entries, optionally only those matching all of the given column values.
+
+        For example, `devices(md5=md5)` lists the devices flashed with the firmware with the given MD5.
+        """
+        unknown = criteria.keys() - set(_columns)
+        if unknown:
+            raise ValueError(f"unknown ledger columns {sorted(unknown)}")
+        where = " AND ".join(f"{column} = ?" for column in criteria)
+        sql = f"SELECT {', '.join(_columns)} FROM devices" + (f" WHERE {where}" if where else "") + " ORDER BY serial"
+        with self._lock:
+            rows = self._db.execute(sql, tuple(criteria.values())).fetchall()
+        return [dict(zip(_columns, row)) for row in rows]
+
+    def is_flashed(self, serial: str, **expected) -> bool:
+        """
+        Determine if the device was last flashed with the expected firmware, given as column values such as `md5`.
+
+        Expected values that are None are not compared. A device is never considered flashed when nothing is expected.
+        """
+        expected = {column: value for column, value in expected.items() if value is not None}
+        if not expected:
+            return False
+        entry = self.get(serial)
+        return bool(entry) and all(entry[column] == value for column, value in expected.items())
+
+
+def add_ledger_argument(parser: argparse.ArgumentParser):
+    """Add the `--ledger` argument, which defaults to the `NOTECARD_LEDGER` environment variable when set."""
+    parser.add_argument(
+        '--ledger',
+        required=False,
+        default=default_ledger(),
+        help='The ledger of firmware flashed to each device. Devices already at the firmware are not flashed again. '
+             'Defaults to $NOTECARD_LEDGER.')
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Add the command-line arguments for querying the ledger to the given parser."""
+    parser.add_argument(
+        '-l',
+        '--ledger',
+        required=default_ledger() is None,
+        default=default_ledger(),
+        help='The ledger to query. Defaults to $NOTECARD_LEDGER.')
+
+    parser.add_argument(
+        'serial',
+        nargs='*',
+        help='The serial numbers of the devices to list. All devices are listed when none are given.')
+
+    parser.add_argument(
+        '--forget',
+        required=False,
+        action='store_true',
+        default=False,
+        help='Remove the given devices from the ledger, so they are flashed on the next run.')
+
+
+def main(args):
+    """Query or update the ledger using the parsed command-line arguments."""
+    with Ledger(args.ledger) as ledger:
+        if args.forget:
+            for serial in args.serial:
+                ledger.forget(serial)
+            return
+        devices = [ledger.get(serial) for serial in args.serial] if args.serial else ledger.devices()
+        for device in devices:
+            if device:
+                print(json.dumps(device), flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Query the ledger of firmware flashed to each device.')
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -1,9 +1,12 @@
 """Updates Notecard firmware using Notehub DFU and a local serial connection to the Notecard."""
 import argparse
 import time
-import notecard
-import serial
-from notecard import Notecard, start_timeout, has_timed_out
+from typing import TYPE_CHECKING
+
+import notecard_ledger
+
+if TYPE_CHECKING:
+    from notecard import Notecard
 
 start = time.time()
 
@@ -14,7 +17,7 @@ def log(s: str):
     print(f"{ts}: {s}", flush=True)
 
 
-def try_transaction(card: Notecard, req: dict):
+def try_transaction(card: "Notecard", req: dict):
     """Perform a request/response transaction, returning the response, or raising an exception when the response is an error."""
     result: dict = card.Transaction(req)
     if result.get("err"):
@@ -22,15 +25,40 @@ def try_transaction(card: Notecard, req: dict):
     return result
 
 
-def _update_notecard_firmware(card: Notecard, filename: str, version: str, timeout: int):
+def _update_notecard_firmware(card: "Notecard", filename: str, version: str, timeout: int,
+                              ledger: notecard_ledger.Ledger = None, progress: dict = None) -> bool:
+    """
+    Update the Notecard firmware, returning True when a DFU was performed, and False when it was skipped.
+
+    `progress` carries the state of the update across retries. The Notecard restarts to apply the firmware, which
+    usually drops the connection, so it is a retry that finds the DFU started by an earlier attempt has completed.
+    The seconds taken to download the firmware are stored in it as `download_secs`.
+    """
+    progress = {} if progress is None else progress
     # check current version
-    if version:
-        card_version = try_transaction(card, {"req": "card.version"})
-        log(f"current version: {card_version['version']}")
-        if version == card_version["version"]:
-            log(
-                f"Skipping update. Notecard firmware at version requested: {version}.")
-            return
+    card_version = try_transaction(card, {"req": "card.version"})
+    current_version = card_version["version"]
+    log(f"current version: {current_version}")
+    if progress.get("dfu_started") and (current_version != progress["from_version"] or current_version == version):
+        log("DFU update started by an earlier attempt has completed.")
+        _clear_dfu_request(card)
+        _check_update(card_version, filename, version, ledger)
+        return True
+
+    if version == current_version:
+        log(
+            f"Skipping update. Notecard firmware at version requested: {version}.")
+        return False
+    device = card_version.get("device")
+    if ledger and ledger.is_flashed(device, name=filename, version=current_version, method="notehub"):
+        log(
+            f"Skipping update. Ledger shows Notecard {device} was last updated to {filename}.")
+        return False
+    if ledger:
+        # the firmware on the card is unknown until the DFU completes
+        ledger.forget(device)
+
+    from notecard import start_timeout
 
     # stop any current DFU operation
     stop_dfu = {"req": "dfu.status", "name": "card", "off": True}
@@ -49,6 +77,8 @@ def _update_notecard_firmware(card: Notecard, filename: str, version: str, timeo
 
         start_dfu = {"req": "dfu.status", "on": True, "name": "card"}
         try_transaction(card, start_dfu)
+        progress.update(dfu_started=True, from_version=current_version, download_start=None)
+        progress.pop("download_secs", None)
 
         try_transaction(card, sync)
 
@@ -57,20 +87,39 @@ def _update_notecard_firmware(card: Notecard, filename: str, version: str, timeo
         # DFU to change status, which is why we wait for it to change from completed.
         wait_for_dfu_mode(card, lambda mode: mode != "completed" and mode != "error",
                           start_time=start_time, timeout_secs=timeout, check_error=False)
+        progress["download_start"] = time.monotonic()
+        # the firmware has downloaded when it is ready to be applied
+        wait_for_dfu_mode(card, lambda mode: mode == "ready" or mode == "completed",
+                          start_time=start_time, timeout_secs=timeout)
+        progress["download_secs"] = time.monotonic() - progress["download_start"]
+        log(f"DFU download complete in {progress['download_secs']:.1f}s.")
         wait_for_dfu_mode(card, lambda mode: mode == "completed",
                           start_time=start_time, timeout_secs=timeout)
         log("DFU update complete.")
 
         card_version = try_transaction(card, {"req": "card.version"})
-        actual_version = card_version["version"]
-        log(f"current version: {actual_version}")
-        if version != actual_version:
-            raise RuntimeError(
-                f"DFU update complete, version mismatch. Expected: {version}, actual: {actual_version}")
+        log(f"current version: {card_version['version']}")
+        _check_update(card_version, filename, version, ledger)
+        return True
     finally:
-        try_transaction(card, {"req": "env.set", "name": "_fwc"})
-        try_transaction(card, {"req": "env.set", "name": "_fwc_retry"})
-        try_transaction(card, sync)
+        _clear_dfu_request(card)
+
+
+def _clear_dfu_request(card: "Notecard"):
+    """Clear the environment variables that request the DFU."""
+    try_transaction(card, {"req": "env.set", "name": "_fwc"})
+    try_transaction(card, {"req": "env.set", "name": "_fwc_retry"})
+    try_transaction(card, {"req": "hub.sync", "allow": True})
+
+
+def _check_update(card_version: dict, filename: str, version: str, ledger: notecard_ledger.Ledger = None):
+    """Check the Notecard is at the version requested once the DFU has completed, and record it in the ledger."""
+    actual_version = card_version["version"]
+    if version and version != actual_version:
+        raise RuntimeError(
+            f"DFU update complete, version mismatch. Expected: {version}, actual: {actual_version}")
+    if ledger:
+        ledger.record(card_version.get("device"), name=filename, version=actual_version, method="notehub")
 
 
 def wait_for_dfu_mode(card, mode_predicate, poll_interval_secs=5, status_timeout=5 * 60, start_time=None,
@@ -82,6 +131,7 @@ def wait_for_dfu_mode(card, mode_predicate, poll_interval_secs=5, status_timeout
     - when the DFU status doesn't change before `status_timeout` seconds have elapsed
     - when the `timeout_secs` has elapsed relative to `start_time`.
     """
+    from notecard import start_timeout
     if not start_time:
         start_time = start_timeout()
     status_start_time = start_timeout()
@@ -105,12 +155,16 @@ def wait_for_dfu_mode(card, mode_predicate, poll_interval_secs=5, status_timeout
 
 def check_timed_out(start_time, timeout_secs, message="Timeout"):
     """Determine if a timeout has occurred from the current time and given start time."""
+    from notecard import has_timed_out
     if has_timed_out(start_time, timeout_secs):
         raise TimeoutError(f"DFU update timeout. {message}")
     return True
 
 
 def _open_notecard(args):
+    import notecard
+    import serial
+    from notecard import start_timeout
     # todo - add I2C
     card = None
     start_time = start_timeout()
@@ -131,14 +185,22 @@ def _open_notecard(args):
     return card
 
 
-def main(args):
-    """Update Notecard firmware using Notehub DFU."""
+def main(args) -> float:
+    """
+    Update Notecard firmware using Notehub DFU.
+
+    Returns the seconds taken to download the firmware, or None when the Notecard was already up to date.
+    """
     # the serial port is closed if it's a USB connection, when the Notecard restarts after
     # applying the firmware. So retries should be at least 2, so the second retry can verify
     # the firmware has been written.
+    validate_arguments(args)
     retries = args.retries
     last_error = None
     success = False
+    # kept across retries, since the retry after the Notecard restarts finds the firmware already updated
+    progress = {}
+    ledger = notecard_ledger.Ledger(args.ledger) if args.ledger else None
     while not success and retries:
         try:
             retries -= 1
@@ -146,32 +208,47 @@ def main(args):
             card = _open_notecard(args)
             log(f"Updating firmware: {args}")
             _update_notecard_firmware(
-                card, args.filename, args.version, args.timeout)
+                card, args.filename, args.version, args.timeout, ledger, progress)
             success = True
         except Exception as e:
             last_error = e
+            if progress.get("download_start") and "download_secs" not in progress:
+                # the connection was lost before the download was seen to finish, so it took at most this long
+                progress["download_secs"] = time.monotonic() - progress["download_start"]
             time.sleep(20)  # sleep to give the Notecard time to restart
-    if last_error:
+    if ledger:
+        ledger.close()
+    if not success:
         log(str(last_error))
         raise Exception("DFU update failed.") from last_error
-    else:
-        log("Success. Exiting.")
+    log("Success. Exiting.")
+    return progress.get("download_secs")
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(
-        description='Update local Notecard firmware via Notehub')
+def validate_arguments(args):
+    """Check that a version is given when there is no ledger, since otherwise the update cannot be verified or skipped."""
+    if not args.version and not args.ledger:
+        raise ValueError("A version is required when no ledger is given.")
 
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Add the command-line arguments for updating firmware via Notehub to the given parser."""
     parser.add_argument(
         '-p',
         '--serial-port',
         required=True,
         help='The serial port the Notecard is available on.')
 
+    add_update_arguments(parser)
+
+
+def add_update_arguments(parser: argparse.ArgumentParser):
+    """Add the command-line arguments for updating firmware via Notehub, apart from the serial port, to the given parser."""
     parser.add_argument(
         '-b',
         '--baudrate',
         default=9600,
+        type=int,
         required=False,
         help='The baudrate of the serial port.')
 
@@ -184,28 +261,38 @@ if __name__ == '__main__':
     parser.add_argument(
         '-v',
         '--version',
-        required=True,
-        help='The version string returned by card.status when the firmware has been updated.')
+        required=False,
+        default=None,
+        help='The version string returned by card.status when the firmware has been updated. '
+             'Required unless a ledger is given.')
 
     parser.add_argument(
         '-r',
         '--retries',
         required=False,
         default=5,
+        type=int,
         help='How many times the DFU is retried on error.')
 
     parser.add_argument('-c',
                         '--card-timeout',
                         required=False,
+                        type=int,
                         default=60,  # 60 secs to wait for the notecard to connect
                         help='How long, in seconds, to wait for the Notecard to become available.')
 
     parser.add_argument('-t',
                         '--timeout',
                         required=False,
+                        type=int,
                         default=30 * 60,
                         help='How long to wait, in seconds, before giving up on the DFU.')
 
-    args = parser.parse_args()
+    notecard_ledger.add_ledger_argument(parser)
+
 
-    main(args)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Update local Notecard firmware via Notehub')
+    add_arguments(parser)
+    main(parser.parse_args())
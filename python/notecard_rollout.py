@@ -0,0 +1,280 @@
+"""
+Roll out Notehub DFU across a fleet of locally connected Notecards.
+
+Starting Notehub DFU on many Notecards at once has them all download the firmware over the same uplink at the same
+time, which slows every download and causes DFU timeouts. The rollout scheduler instead admits Notecards gradually:
+
+* canaries - the first Notecards are updated on their own, and the rollout halts if any of them fail
+* concurrency - at most `max_concurrency` Notecards are updated at once
+* bandwidth - when a bandwidth budget is given, the number of concurrent updates is limited so that Notecards
+  downloading at the uncontended rate observed do not exceed the budget
+* adaptive admission - the number of concurrent updates grows by one with each firmware download that completes in
+  close to the fastest time observed, and halves when a download is much slower than that, or an update fails, which
+  indicates the uplink is saturated
+* error rate - the rollout halts when the proportion of failed updates exceeds `max_error_rate`
+
+Notecards already up to date are skipped without downloading anything, so they are left out of the download times
+and the error rate. Updates already in progress when the rollout halts are allowed to finish.
+"""
+
+import argparse
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import notecard_firmware_query
+import notecard_local_firmware_notehub_update
+
+
+class RolloutScheduler:
+    """
+    Schedules updates of a fleet of Notecards, admitting them under concurrency and bandwidth budgets.
+
+    `update` is called with each card to update it. It returns the seconds taken to download the firmware, or None
+    when the card was already up to date, and raises an exception when the update fails.
+    `image_size` is the firmware size in bytes, and `bandwidth` the budget in bytes per second. The bandwidth budget
+    only applies when both are given. An update taking more than `slowdown` times the fastest update is considered
+    to be slowed by contention.
+    """
+
+    def __init__(self, update, max_concurrency: int = 4, image_size: int = None, bandwidth: float = None,
+                 canaries: int = 1, max_error_rate: float = 0.2, min_samples: int = 3, slowdown: float = 1.5):
+        """Create a scheduler that updates cards with `update`."""
+        self.update = update
+        self.max_concurrency = max_concurrency
+        self.image_size = image_size
+        self.bandwidth = bandwidth
+        self.canaries = canaries
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.slowdown = slowdown
+
+        self.window = 1
+        self.fastest_secs = None
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.peak_concurrency = 0
+        self.halt_reason = None
+        self.elapsed_secs = 0.0
+
+    def record(self, duration_secs: float, ok: bool):
+        """
+        Record the outcome of an update, adapting the number of concurrent updates admitted.
+
+        `duration_secs` is the time taken to download the firmware. Skipped updates are not recorded.
+        """
+        if ok:
+            self.succeeded += 1
+            self.fastest_secs = min(self.fastest_secs or duration_secs, duration_secs)
+        else:
+            self.failed += 1
+
+        if ok and duration_secs <= self.fastest_secs * self.slowdown:
+            self.window = min(self.window + 1, self.max_concurrency)
+        else:
+            self.window = max(self.window // 2, 1)
+
+        finished = self.succeeded + self.failed
+        if finished >= self.min_samples and self.failed / finished > self.max_error_rate:
+            self.halt(f"error rate {self.failed}/{finished} exceeds {self.max_error_rate:.0%}")
+
+    def halt(self, reason: str):
+        """Stop admitting cards for update."""
+        if not self.halt_reason:
+            self.halt_reason = reason
+
+    def bandwidth_limit(self) -> int:
+        """
+        Determine how many cards can download at the fastest rate observed without exceeding the bandwidth budget.
+
+        >>> scheduler = RolloutScheduler(None, max_concurrency=10, image_size=1000, bandwidth=500)
+        >>> scheduler.bandwidth_limit()
+        10
+        >>> scheduler.record(4, True)   # 250 bytes per second
+        >>> scheduler.bandwidth_limit()
+        2
+        """
+        if not (self.bandwidth and self.image_size and self.fastest_secs):
+            return self.max_concurrency
+        per_card_rate = self.image_size / self.fastest_secs
+        return max(int(self.bandwidth // per_card_rate), 1)
+
+    def admission_limit(self) -> int:
+        """Determine how many cards can be updated concurrently."""
+        return min(self.window, self.max_concurrency, self.bandwidth_limit())
+
+    def finished(self) -> int:
+        """Count the updates that have finished, including those skipped."""
+        return self.succeeded + self.failed + self.skipped
+
+    def run(self, cards: list) -> list[dict]:
+        """Update the cards, returning the outcome of each: 'ok', 'skipped', 'failed' or 'not started'."""
+        start = time.monotonic()
+        results = {card: {"card": card, "status": "not started"} for card in cards}
+        pending = list(cards)
+        canaries = pending[:self.canaries]
+        canary_count = len(canaries)
+        wave = 0
+
+        with ThreadPoolExecutor(max_workers=max(self.max_concurrency, len(canaries), 1)) as executor:
+            in_flight = {}
+            while (pending and not self.halt_reason) or in_flight:
+                if canaries:
+                    limit = len(canaries)
+                elif self.finished() < canary_count:
+                    limit = 0   # wait for the canaries to finish
+                else:
+                    limit = self.admission_limit()
+
+                admitted = []
+                while pending and not self.halt_reason and len(in_flight) < limit:
+                    card = pending.pop(0)
+                    in_flight[executor.submit(self.update, card)] = card
+                    admitted.append(card)
+                if admitted:
+                    wave += 1
+                    print(f"Wave {wave}: updating {admitted}, {len(in_flight)} in progress, "
+                          f"limit {limit}.", flush=True)
+                    canaries = []
+                self.peak_concurrency = max(self.peak_concurrency, len(in_flight))
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    card = in_flight.pop(future)
+                    try:
+                        duration_secs = future.result()
+                        if duration_secs is None:
+                            results[card]["status"] = "skipped"
+                            self.skipped += 1
+                        else:
+                            results[card] |= {"status": "ok", "duration_secs": round(duration_secs, 3)}
+                            self.record(duration_secs, True)
+                    except Exception as e:
+                        results[card] |= {"status": "failed", "error": str(e)}
+                        if self.finished() < canary_count:
+                            self.halt(f"canary {card} failed")
+                        self.record(0, False)
+
+        self.elapsed_secs = time.monotonic() - start
+        return list(results.values())
+
+    def report(self) -> str:
+        """Summarize the rollout."""
+        lines = [f"rollout finished in {self.elapsed_secs:.1f}s: {self.succeeded} succeeded, {self.failed} failed, "
+                 f"{self.skipped} skipped, peak concurrency {self.peak_concurrency}"]
+        if self.fastest_secs:
+            lines.append(f"fastest download {self.fastest_secs:.1f}s, final admission limit {self.admission_limit()}")
+        if self.halt_reason:
+            lines.append(f"halted: {self.halt_reason}")
+        return "\n".join(lines)
+
+
+def _notehub_update(args):
+    """
+    Create a function that updates the Notecard on a given serial port using Notehub DFU.
+
+    The function returns the seconds taken to download the firmware, or None when the Notecard was already up to date.
+    """
+    def update(serial_port: str) -> float:
+        card_args = argparse.Namespace(**vars(args))
+        card_args.serial_port = serial_port
+        return notecard_local_firmware_notehub_update.main(card_args)
+    return update
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Add the command-line arguments for a fleet rollout to the given parser."""
+    parser.add_argument(
+        'serial_ports',
+        nargs='+',
+        help='The serial ports of the Notecards to update, in rollout order. The first are the canaries.')
+
+    notecard_local_firmware_notehub_update.add_update_arguments(parser)
+
+    parser.add_argument(
+        '--max-concurrency',
+        required=False,
+        type=int,
+        default=4,
+        help='The most Notecards updated at once.')
+
+    parser.add_argument(
+        '--bandwidth',
+        required=False,
+        type=float,
+        default=None,
+        help='The bandwidth budget for firmware downloads, in bytes per second.')
+
+    parser.add_argument(
+        '--image-size',
+        required=False,
+        type=int,
+        default=None,
+        help='The firmware size in bytes, for the bandwidth budget. Queried from Notehub when not given.')
+
+    parser.add_argument(
+        '--canaries',
+        required=False,
+        type=int,
+        default=1,
+        help='How many Notecards are updated first. The rollout halts if any of them fail.')
+
+    parser.add_argument(
+        '--max-error-rate',
+        required=False,
+        type=float,
+        default=0.2,
+        help='The proportion of failed updates, from 0 to 1, above which the rollout halts.')
+
+    parser.add_argument(
+        '--min-samples',
+        required=False,
+        type=int,
+        default=3,
+        help='How many updates must finish before the error rate is checked.')
+
+    parser.add_argument(
+        '--slowdown',
+        required=False,
+        type=float,
+        default=1.5,
+        help='How many times slower than the fastest update an update can be before admission is reduced.')
+
+    notecard_firmware_query.add_notehub_argument(parser)
+
+
+def main(args):
+    """Roll out firmware to a fleet of Notecards using the parsed command-line arguments."""
+    notecard_local_firmware_notehub_update.validate_arguments(args)
+    image_size = args.image_size
+    if args.bandwidth and not image_size:
+        image_size = notecard_firmware_query.find_firmware(name=args.filename, allow=True,
+                                                           notehub=args.notehub)["length"]
+
+    scheduler = RolloutScheduler(_notehub_update(args), max_concurrency=args.max_concurrency,
+                                 image_size=image_size, bandwidth=args.bandwidth, canaries=args.canaries,
+                                 max_error_rate=args.max_error_rate, min_samples=args.min_samples,
+                                 slowdown=args.slowdown)
+    results = scheduler.run(args.serial_ports)
+
+    for result in results:
+        outcome = result["status"]
+        if result.get("error"):
+            outcome += f", {result['error']}"
+        elif result["status"] == "skipped":
+            outcome += ", already up to date"
+        elif result.get("duration_secs") is not None:
+            outcome += f", downloaded in {result['duration_secs']:.1f}s"
+        print(f"{result['card']}: {outcome}", flush=True)
+    print(scheduler.report(), flush=True)
+
+    if scheduler.halt_reason or scheduler.failed:
+        raise RuntimeError(f"Rollout incomplete. {scheduler.failed} updates failed.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Update a fleet of local Notecards via Notehub, admitting them under concurrency and '
+                    'bandwidth budgets.')
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,68 @@
+"""
+A single command-line entry point for the Notecard firmware tools.
+
+Each tool is available as a subcommand of `notecard-tools`:
+
+* `query` - find firmware on Notehub
+* `get` - download firmware from Notehub
+* `dfu-util` - flash a local firmware file using dfu-util
+* `notehub-update` - update a locally connected Notecard via Notehub DFU
+* `mirror` - serve Notehub firmware to other hosts from a local cache
+* `pipeline` - resolve, download and flash firmware for many devices concurrently
+* `ledger` - query the ledger of firmware flashed to each device
+* `verify` - verify the integrity of a directory of downloaded firmware
+* `rollout` - update a fleet of local Notecards via Notehub DFU under concurrency and bandwidth budgets
+
+Only the module implementing the selected command is imported, and the tool modules only import their heavy
+dependencies, such as `requests` and `notecard`, in the code paths that use them. So a command only pays the import
+cost of what it needs.
+"""
+
+import argparse
+import importlib
+import sys
+
+prog = "notecard-tools"
+
+# subcommand name -> (module name, description)
+commands = {
+    "query": ("notecard_firmware_query", "Query available firmware from Notehub."),
+    "get": ("notecard_firmware_get", "Retrieve available firmware from Notehub."),
+    "dfu-util": ("notecard_dfu_util", "Update Notecard firmware using dfu-util."),
+    "notehub-update": ("notecard_local_firmware_notehub_update", "Update local Notecard firmware via Notehub."),
+    "mirror": ("notecard_firmware_mirror", "Serve Notehub firmware from a local cache."),
+    "pipeline": ("notecard_firmware_pipeline", "Resolve, download and flash firmware for many devices concurrently."),
+    "ledger": ("notecard_ledger", "Query the ledger of firmware flashed to each device."),
+    "verify": ("notecard_firmware_verify", "Verify the integrity of a directory of firmware files."),
+    "rollout": ("notecard_rollout", "Update a fleet of local Notecards via Notehub DFU under concurrency and bandwidth budgets."),
+}
+
+
+def build_parser(argv: list[str]) -> argparse.ArgumentParser:
+    """
+    Build the argument parser, with one subparser per command.
+
+    Only the arguments of the command selected in `argv` are added, so only that command's module is imported.
+    """
+    selected = next((arg for arg in argv if not arg.startswith("-")), None)
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Notecard firmware tools.')
+    subparsers = parser.add_subparsers(dest="command", required=True, metavar="command")
+    for name, (module_name, description) in commands.items():
+        subparser = subparsers.add_parser(name, help=description, description=description)
+        if name == selected:
+            module = importlib.import_module(module_name)
+            module.add_arguments(subparser)
+            subparser.set_defaults(func=module.main)
+    return parser
+
+
+def main(argv: list[str]):
+    """Parse the command line and run the selected command."""
+    args = build_parser(argv).parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,6 +1,9 @@
+import hashlib
+import json
 import pytest
 import notecard_dfu_util
 import re
+from notecard_ledger import Ledger
 
 # Output captured from `dfu-util -l` with two Notecards connected via USB, both in bootloader mode
 dfu_list_two_notecards = """
@@ -53,11 +56,236 @@ class TestDfuUtil:
         filename = "abc#def.bin"
         serial = "CANTFINDME"
         # errormsg is a Regex and has been escaped accordingly
-        errormsg = "Cannot find a DFU region matching {'vid': '0483', 'pid': 'df11', 'name': '@Internal Flash  /0x08000000/512*0004Kg', 'serial': 'CANTFINDME'}"
+        errormsg = "Cannot find a DFU region matching {'vid': '0483', 'pid': 'df11', 'serial': 'CANTFINDME'} with Internal Flash at 0x8000000"
         with pytest.raises(RuntimeError, match=re.escape(errormsg) + ".*"):
             notecard_dfu_util.build_dfu_util_command_args(
                 dfu_list, serial, filename)
 
+    def test_uses_flash_layout_reported_by_device(self, tmp_path, monkeypatch):
+        dfu_list = dfu_list_two_notecards.replace("@Internal Flash  /0x08000000/512*0004Kg",
+                                                  "@Internal Flash /0x08000000/128*0008Kg")
+        commands = self.fake_dfu_util(monkeypatch, dfu_list=dfu_list)
+        filename = str(tmp_path / "notecard.bin")
+        with open(filename, "wb") as f:
+            f.truncate(1024 * 1024 + 1)
+        with pytest.raises(ValueError, match="exceeds Internal Flash region 0x8000000-0x8100000"):
+            notecard_dfu_util.dfu_util(filename, "205B3875594D", 60)
+        assert commands == [["-l"]]
+
+    def test_leave_dfu_command_args(self):
+        cmd_args = notecard_dfu_util.build_leave_dfu_command_args(
+            dfu_list_two_notecards, "205B3875594D", "leave.bin")
+        assert cmd_args == ["-n", "5", "-a", "0", "-s", "0x8000000:leave:4", "-U", "leave.bin"]
+
+    def test_ledger_skips_device_already_flashed(self, tmp_path, monkeypatch):
+        commands = self.fake_dfu_util(monkeypatch)
+        filename = str(tmp_path / "notecard.bin")
+        with open(filename, "wb") as f:
+            f.write(b"firmware")
+
+        with Ledger(str(tmp_path / "ledger.db")) as ledger:
+            assert notecard_dfu_util.dfu_util(filename, "205B3875594D", 60, ledger)
+            assert ledger.get("205B3875594D")["name"] == "notecard.bin"
+            assert notecard_dfu_util.dfu_util(filename, "205B3875594D", 60, ledger) is False
+
+        transfers = [args for args in commands if "-D" in args]
+        leaves = [args for args in commands if "-U" in args]
+        assert len(transfers) == 1
+        assert len(leaves) == 1
+
+    def test_ledger_flashes_changed_firmware(self, tmp_path, monkeypatch):
+        commands = self.fake_dfu_util(monkeypatch)
+        filename = str(tmp_path / "notecard.bin")
+        with Ledger(str(tmp_path / "ledger.db")) as ledger:
+            for content in [b"firmware 1", b"firmware 2"]:
+                with open(filename, "wb") as f:
+                    f.write(content)
+                assert notecard_dfu_util.dfu_util(filename, "205B3875594D", 60, ledger)
+        assert len([args for args in commands if "-D" in args]) == 2
+
+    def test_rejects_image_larger_than_flash(self, tmp_path, monkeypatch):
+        commands = self.fake_dfu_util(monkeypatch)
+        filename = str(tmp_path / "notecard.bin")
+        with open(filename, "wb") as f:
+            f.truncate(512 * 4096 + 1)
+        with pytest.raises(ValueError, match="exceeds Internal Flash region"):
+            notecard_dfu_util.dfu_util(filename, "205B3875594D", 60)
+        assert commands == [["-l"]]
+
+    def test_incremental_writes_changed_sectors(self, tmp_path, monkeypatch):
+        previous_image = bytes(4096) * 3
+        image = bytes(4096) + b"\x01" * 4096 + bytes(4096)
+        filename, previous = self.write_images(tmp_path, image, previous_image)
+        commands = self.fake_dfu_util(monkeypatch, device_image=previous_image)
+
+        notecard_dfu_util.dfu_util(filename, "205B3875594D", 60, incremental=True, previous=previous)
+
+        transfers = [args for args in commands if "-D" in args]
+        assert len(transfers) == 1
+        assert transfers[0][:6] == ["-n", "5", "-a", "0", "-s", "0x8001000"]
+        assert self.transferred[0] == b"\x01" * 4096
+        uploads = [args[5] for args in commands if "-U" in args]
+        assert uploads == ["0x8000000:12288", "0x8000000:leave:4"]
+
+    def test_incremental_merges_nearby_runs(self, tmp_path, monkeypatch):
+        previous_image = bytes(4096) * 8
+        image = b"\x01" * 4096 + bytes(4096) + b"\x01" * 4096 + bytes(4096) * 5
+        filename, previous = self.write_images(tmp_path, image, previous_image)
+        commands = self.fake_dfu_util(monkeypatch, device_image=previous_image)
+
+        notecard_dfu_util.dfu_util(filename, "205B3875594D", 60, incremental=True, previous=previous)
+
+        transfers = [args for args in commands if "-D" in args]
+        assert len(transfers) == 1
+        assert transfers[0][5] == "0x8000000"
+        assert self.transferred == [image[:3 * 4096]]
+
+    def test_incremental_falls_back_to_full_dfu_for_many_runs(self, tmp_path, monkeypatch):
+        previous_image = bytes(4096) * 100
+        image = bytearray(previous_image)
+        for sector in range(0, 100, 20):
+            image[sector * 4096] = 1
+        filename, previous = self.write_images(tmp_path, bytes(image), previous_image)
+        commands = self.fake_dfu_util(monkeypatch)
+
+        notecard_dfu_util.dfu_util(filename, "205B3875594D", 60, incremental=True, previous=previous)
+
+        transfers = [args for args in commands if "-D" in args]
+        self.assert_cmd_args(transfers[0], 5, filename)
+        assert len(transfers) == 1
+
+    def test_incremental_falls_back_to_full_dfu_for_large_changes(self, tmp_path, monkeypatch):
+        filename, previous = self.write_images(tmp_path, b"\x01" * 4096 * 3, bytes(4096) * 3)
+        commands = self.fake_dfu_util(monkeypatch)
+
+        notecard_dfu_util.dfu_util(filename, "205B3875594D", 60, incremental=True, previous=previous)
+
+        transfers = [args for args in commands if "-D" in args]
+        self.assert_cmd_args(transfers[0], 5, filename)
+        assert len(transfers) == 1
+
+    def test_incremental_falls_back_to_full_dfu_when_previous_image_is_wrong(self, tmp_path, monkeypatch):
+        image = bytes(4096) + b"\x01" * 4096 + bytes(4096)
+        filename, previous = self.write_images(tmp_path, image, bytes(4096) * 3)
+        commands = self.fake_dfu_util(monkeypatch, device_image=b"\x02" * 4096 * 3)
+
+        with Ledger(str(tmp_path / "ledger.db")) as ledger:
+            assert notecard_dfu_util.dfu_util(filename, "205B3875594D", 60, ledger=ledger, incremental=True,
+                                              previous=previous)
+            assert ledger.get("205B3875594D")["md5"] == hashlib.md5(image).hexdigest()
+
+        transfers = [args for args in commands if "-D" in args]
+        assert len(transfers) == 2
+        self.assert_cmd_args(transfers[1], 5, filename)
+        assert [args[5] for args in commands if "-U" in args] == ["0x8000000:12288"]
+
+    def test_incremental_uses_image_recorded_in_ledger(self, tmp_path, monkeypatch):
+        previous_image = bytes(4096) * 3
+        image = bytes(4096) * 2 + b"\x01"
+        filename, previous = self.write_images(tmp_path, image, previous_image)
+        commands = self.fake_dfu_util(monkeypatch, device_image=previous_image)
+
+        with Ledger(str(tmp_path / "ledger.db")) as ledger:
+            ledger.record("205B3875594D", name="previous.bin", md5=hashlib.md5(previous_image).hexdigest(),
+                          method="dfu-util")
+            notecard_dfu_util.dfu_util(filename, "205B3875594D", 60, ledger=ledger, incremental=True)
+
+        uploads = [args[5] for args in commands if "-U" in args]
+        assert uploads == ["0x8000000:8193", "0x8000000:leave:4"]
+        assert self.transferred == [b"\x01"]
+
+    def test_incremental_reads_back_when_ledger_entry_is_not_from_dfu_util(self, tmp_path, monkeypatch):
+        previous_image = bytes(4096) * 2
+        image = bytes(4096) + b"\x01"
+        filename, previous = self.write_images(tmp_path, image, previous_image)
+        commands = self.fake_dfu_util(monkeypatch, device_image=b"\x02" * 8192)
+
+        with Ledger(str(tmp_path / "ledger.db")) as ledger:
+            ledger.record("205B3875594D", name="previous.bin", md5=hashlib.md5(previous_image).hexdigest(),
+                          method="notehub")
+            notecard_dfu_util.dfu_util(filename, "205B3875594D", 60, ledger=ledger, incremental=True)
+
+        uploads = [args[5] for args in commands if "-U" in args]
+        assert uploads[0] == "0x8000000:4097"
+        assert self.transferred == [image]
+
+    def test_forgets_device_before_transfer(self, tmp_path, monkeypatch):
+        filename = str(tmp_path / "notecard.bin")
+        with open(filename, "wb") as f:
+            f.write(b"firmware")
+        self.fake_dfu_util(monkeypatch, fail_transfer=True)
+
+        with Ledger(str(tmp_path / "ledger.db")) as ledger:
+            ledger.record("205B3875594D", name="old.bin", md5="d41d8cd98f00b204e9800998ecf8427e", method="dfu-util")
+            with pytest.raises(RuntimeError, match="transfer failed"):
+                notecard_dfu_util.dfu_util(filename, "205B3875594D", 60, ledger=ledger)
+            assert ledger.get("205B3875594D") is None
+
+    def test_incremental_reads_back_previous_image(self, tmp_path, monkeypatch):
+        image = b"\x01" * 4096 + bytes(4096)
+        filename, _ = self.write_images(tmp_path, image, None)
+        commands = self.fake_dfu_util(monkeypatch, device_image=bytes(8192))
+
+        notecard_dfu_util.dfu_util(filename, "205B3875594D", 60, incremental=True)
+
+        uploads = [args for args in commands if "-U" in args]
+        assert uploads[0][4:6] == ["-s", "0x8000000:8192"]
+        transfers = [args for args in commands if "-D" in args]
+        assert transfers[0][4:6] == ["-s", "0x8000000"]
+        assert self.transferred == [b"\x01" * 4096]
+
+    def test_incremental_without_changes_leaves_bootloader(self, tmp_path, monkeypatch):
+        filename, previous = self.write_images(tmp_path, bytes(4096), bytes(4096))
+        commands = self.fake_dfu_util(monkeypatch, device_image=bytes(4096))
+
+        notecard_dfu_util.dfu_util(filename, "205B3875594D", 60, incremental=True, previous=previous)
+
+        assert not [args for args in commands if "-D" in args]
+        assert [args[5] for args in commands if "-U" in args] == ["0x8000000:4096", "0x8000000:leave:4"]
+
+    def write_images(self, tmp_path, image, previous_image):
+        filename = str(tmp_path / "notecard.bin")
+        with open(filename, "wb") as f:
+            f.write(image)
+        previous = None
+        if previous_image is not None:
+            previous = str(tmp_path / "previous.bin")
+            with open(previous, "wb") as f:
+                f.write(previous_image)
+            with open(f"{previous}.json", "w") as f:
+                json.dump({"md5": hashlib.md5(previous_image).hexdigest()}, f)
+        return filename, previous
+
+    def fake_dfu_util(self, monkeypatch, device_image=b"", fail_transfer=False,
+                      dfu_list=dfu_list_two_notecards):
+        """Simulate dfu-util against a device whose flash starts with `device_image`."""
+        commands = []
+        self.transferred = []
+        flash = bytearray(device_image)
+
+        def run_command(cmd, cmd_args, timeout=None, capture_output=True):
+            commands.append(cmd_args)
+            if cmd_args == ["-l"]:
+                return dfu_list
+            address, *modifiers = cmd_args[cmd_args.index("-s") + 1].split(":")
+            offset = int(address, 16) - 0x8000000
+            if "-D" in cmd_args:
+                if fail_transfer:
+                    raise RuntimeError("transfer failed")
+                with open(cmd_args[cmd_args.index("-D") + 1], "rb") as f:
+                    data = f.read()
+                self.transferred.append(data)
+                flash[len(flash):] = bytes(max(offset + len(data) - len(flash), 0))
+                flash[offset:offset + len(data)] = data
+            if "-U" in cmd_args:
+                length = int(modifiers[-1])
+                with open(cmd_args[cmd_args.index("-U") + 1], "xb") as f:
+                    f.write(bytes(flash[offset:offset + length]))
+            return ""
+
+        monkeypatch.setattr(notecard_dfu_util, "run_command", run_command)
+        return commands
+
     def assert_cmd_args(self, cmd_args, devnum, filename):
         assert cmd_args[0] == "-n"
         assert cmd_args[1] == str(devnum)
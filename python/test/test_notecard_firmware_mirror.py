@@ -0,0 +1,147 @@
+import base64
+import hashlib
+import http.client
+import json
+import threading
+import time
+
+import pytest
+import notecard_firmware_get
+import notecard_firmware_mirror
+
+firmware_name = "notecard-5.1.1.16026$20230523.bin"
+firmware_bytes = bytes(range(256)) * 40
+
+
+class FakeUpstream:
+    """Stands in for `notecard_firmware_get._get_notecard_firmware`, counting the calls made."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self, filename, existing_md5=None, notehub=None):
+        self.calls += 1
+        time.sleep(self.delay)
+        firmware_json = {"name": filename, "firmware": {"ver_major": 5},
+                         "length": len(firmware_bytes), "md5": hashlib.md5(firmware_bytes).hexdigest()}
+        return firmware_json, base64.b64encode(firmware_bytes).decode("ascii")
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    fake = FakeUpstream()
+    monkeypatch.setattr(notecard_firmware_get, "_get_notecard_firmware", fake)
+    return fake
+
+
+@pytest.fixture
+def mirror(tmp_path, upstream):
+    return notecard_firmware_mirror.FirmwareMirror(str(tmp_path))
+
+
+@pytest.fixture
+def server(mirror):
+    server = notecard_firmware_mirror.create_server(mirror, "127.0.0.1", 0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def http_request(server, method, path, body=None, headers=None):
+    connection = http.client.HTTPConnection("127.0.0.1", server.server_port)
+    try:
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        connection.close()
+
+
+class TestFirmwareMirror:
+
+    def test_coalesces_concurrent_misses(self, mirror, upstream):
+        upstream.delay = 0.2
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(mirror.firmware(firmware_name)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert upstream.calls == 1
+        assert len(results) == 8
+        assert all(result["md5"] == hashlib.md5(firmware_bytes).hexdigest() for result in results)
+
+    def test_serves_from_cache(self, mirror, upstream):
+        mirror.firmware(firmware_name)
+        mirror.firmware(firmware_name)
+        assert upstream.calls == 1
+
+    def test_refetches_corrupt_cache_entry(self, mirror, upstream):
+        mirror.firmware(firmware_name)
+        with open(mirror.path(firmware_name), "r+b") as f:
+            f.write(b"\xff\xff")
+        assert mirror.read(firmware_name) == firmware_bytes
+        assert upstream.calls == 2
+
+    def test_get_with_offset_and_length(self, mirror):
+        response = mirror.request({"req": "hub.upload.get", "name": firmware_name, "offset": 100, "length": 50})
+        payload = base64.b64decode(response["payload"])
+        assert payload == firmware_bytes[100:150]
+        assert response["length"] == 50
+        assert response["md5"] == hashlib.md5(payload).hexdigest()
+        assert response["body"]["length"] == len(firmware_bytes)
+
+    def test_get_without_length_returns_descriptor(self, mirror):
+        response = mirror.request({"req": "hub.upload.get", "name": firmware_name})
+        assert "payload" not in response
+        assert response["body"]["name"] == firmware_name
+
+    def test_file_md5_reads_in_chunks(self, tmp_path):
+        filename = tmp_path / "firmware.bin"
+        filename.write_bytes(firmware_bytes)
+        assert notecard_firmware_get.file_md5(str(filename), chunk_size=1000) == hashlib.md5(firmware_bytes).hexdigest()
+        assert notecard_firmware_get.file_md5(str(tmp_path / "missing.bin")) is None
+
+    def test_lists_last_firmware_when_upstream_fails(self, tmp_path, monkeypatch):
+        mirror = notecard_firmware_mirror.FirmwareMirror(str(tmp_path), query_ttl=0)
+        listing = [{"name": firmware_name}]
+        monkeypatch.setattr(mirror, "_query_upstream", lambda allow: listing)
+        assert mirror.list_firmware(False) == listing
+
+        def unavailable(allow):
+            raise RuntimeError("upstream unavailable")
+        monkeypatch.setattr(mirror, "_query_upstream", unavailable)
+        assert mirror.list_firmware(False) == listing
+        with pytest.raises(RuntimeError, match="upstream unavailable"):
+            mirror.list_firmware(True)
+
+    def test_rejects_path_names(self, mirror):
+        with pytest.raises(ValueError):
+            mirror.path("../secret")
+
+    def test_serves_notehub_request_over_http(self, server):
+        req = {"req": "hub.upload.get", "type": "notecard", "name": firmware_name, "length": len(firmware_bytes)}
+        status, _, content = http_request(server, "GET", "/req", json.dumps(req))
+        assert status == 200
+        response = json.loads(content)
+        # the client validates the response the same way as for Notehub
+        payload_bytes = notecard_firmware_get._validate(
+            response["body"] | {"md5": response["md5"]}, response["payload"], None)
+        assert payload_bytes == firmware_bytes
+
+    def test_serves_range_over_http(self, server):
+        status, headers, content = http_request(server, "GET", f"/uploads/{firmware_name}",
+                                                headers={"Range": "bytes=10-19"})
+        assert status == 206
+        assert content == firmware_bytes[10:20]
+        assert headers["Content-Range"] == f"bytes 10-19/{len(firmware_bytes)}"
+
+    def test_rejects_unsupported_request(self, server):
+        status, _, content = http_request(server, "POST", "/req", json.dumps({"req": "card.version"}))
+        assert status == 400
+        assert "err" in json.loads(content)
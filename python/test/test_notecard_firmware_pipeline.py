@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+import notecard_dfu_util
+import notecard_firmware_get
+import notecard_firmware_pipeline
+import notecard_firmware_query
+from notecard_firmware_pipeline import Pipeline, Stage
+
+
+class Recorder:
+    """Records when each stage starts and ends for each job."""
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def stage(self, name, duration, fail_serial=None):
+        def func(job):
+            with self._lock:
+                self.events.append(("start", name, job["serial"], time.monotonic()))
+            time.sleep(duration)
+            if job["serial"] == fail_serial:
+                raise RuntimeError("device not found")
+            with self._lock:
+                self.events.append(("end", name, job["serial"], time.monotonic()))
+        return func
+
+    def time_of(self, event, name, serial):
+        return next(t for e, n, s, t in self.events if (e, n, s) == (event, name, serial))
+
+
+def jobs(count):
+    return [{"version": "5.1", "serial": f"SERIAL{i}"} for i in range(count)]
+
+
+class TestPipeline:
+
+    def test_flashes_while_downloads_continue(self):
+        recorder = Recorder()
+        stages = [Stage("resolve", recorder.stage("resolve", 0)),
+                  Stage("download", recorder.stage("download", 0.1)),
+                  Stage("flash", recorder.stage("flash", 0.1), workers=4)]
+        pipeline = Pipeline(stages)
+        results = pipeline.run(jobs(4))
+
+        assert len(results) == 4
+        assert not any(job.get("error") for job in results)
+        # the first device is flashed while the last image is still downloading
+        assert recorder.time_of("start", "flash", "SERIAL0") < recorder.time_of("end", "download", "SERIAL3")
+
+    @pytest.mark.timing
+    def test_overlapping_stages_take_less_than_sequential_time(self):
+        recorder = Recorder()
+        stages = [Stage("resolve", recorder.stage("resolve", 0)),
+                  Stage("download", recorder.stage("download", 0.1)),
+                  Stage("flash", recorder.stage("flash", 0.1), workers=4)]
+        pipeline = Pipeline(stages)
+        pipeline.run(jobs(4))
+
+        # sequential execution would take 0.8s
+        assert pipeline.elapsed_secs < 0.7
+        assert stages[1].utilization(pipeline.elapsed_secs) > 0.6
+
+    def test_failed_jobs_skip_later_stages(self):
+        recorder = Recorder()
+        stages = [Stage("download", recorder.stage("download", 0, fail_serial="SERIAL1")),
+                  Stage("flash", recorder.stage("flash", 0), workers=2)]
+        pipeline = Pipeline(stages)
+        results = pipeline.run(jobs(3))
+
+        failed = [job for job in results if job.get("error")]
+        assert [job["serial"] for job in failed] == ["SERIAL1"]
+        assert failed[0]["error"] == "download: device not found"
+        assert stages[1].processed == 2
+        assert "download: 3 jobs, 1 failed" in pipeline.report()
+
+    def test_shared_firmware_is_resolved_and_downloaded_once(self, monkeypatch, tmp_path):
+        calls = {"find": 0, "download": 0, "flash": []}
+
+        def find_firmware(name, allow, version, target, notehub):
+            calls["find"] += 1
+            return {"name": f"notecard-{version}.bin"}
+
+        def download_firmware(filename, notehub, path):
+            calls["download"] += 1
+
+        def dfu_util(filename, serial_number, timeout, ledger=None, incremental=False):
+            calls["flash"].append((filename, serial_number))
+            return True
+
+        monkeypatch.setattr(notecard_firmware_query, "find_firmware", find_firmware)
+        monkeypatch.setattr(notecard_firmware_get, "download_firmware", download_firmware)
+        monkeypatch.setattr(notecard_dfu_util, "dfu_util", dfu_util)
+
+        stages = notecard_firmware_pipeline.firmware_stages(str(tmp_path), flash_workers=3)
+        results = Pipeline(stages).run(jobs(3))
+
+        assert not any(job.get("error") for job in results)
+        assert calls["find"] == 1
+        assert calls["download"] == 1
+        path = str(tmp_path / "notecard-5.1.bin")
+        assert sorted(calls["flash"]) == [(path, f"SERIAL{i}") for i in range(3)]
+
+    def test_creates_firmware_directory(self, tmp_path):
+        directory = tmp_path / "firmware" / "notecard"
+        notecard_firmware_pipeline.firmware_stages(str(directory))
+        assert directory.is_dir()
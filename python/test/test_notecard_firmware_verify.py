@@ -0,0 +1,76 @@
+import hashlib
+import json
+
+import notecard_firmware_get
+import notecard_firmware_verify
+
+
+def save_firmware(directory, name, content, md5=None, length=None):
+    descriptor = {"name": name, "md5": md5 or hashlib.md5(content).hexdigest(),
+                  "length": len(content) if length is None else length}
+    notecard_firmware_get._save(str(directory / name), descriptor, content)
+
+
+def statuses(report):
+    return {result["name"]: result["status"] for result in report["files"]}
+
+
+class TestVerify:
+
+    def test_file_digest_reads_in_chunks(self, tmp_path):
+        content = bytes(range(256)) * 1000
+        filename = tmp_path / "firmware.bin"
+        filename.write_bytes(content)
+        assert notecard_firmware_verify.file_digest(str(filename), chunk_size=1000) == \
+            (hashlib.md5(content).hexdigest(), len(content))
+
+    def test_file_digest_of_empty_file(self, tmp_path):
+        filename = tmp_path / "empty.bin"
+        filename.write_bytes(b"")
+        assert notecard_firmware_verify.file_digest(str(filename)) == (hashlib.md5(b"").hexdigest(), 0)
+
+    def test_reports_each_file(self, tmp_path):
+        save_firmware(tmp_path, "good.bin", b"good firmware")
+        save_firmware(tmp_path, "bad-md5.bin", b"bad firmware", md5="d41d8cd98f00b204e9800998ecf8427e")
+        save_firmware(tmp_path, "bad-length.bin", b"short", length=100)
+        save_firmware(tmp_path, "missing.bin", b"missing")
+        (tmp_path / "missing.bin").unlink()
+        (tmp_path / "unrelated.txt").write_text("not firmware")
+
+        report = notecard_firmware_verify.verify_firmware(str(tmp_path), workers=2)
+
+        assert statuses(report) == {"good.bin": "ok", "bad-md5.bin": "mismatch",
+                                    "bad-length.bin": "mismatch", "missing.bin": "missing"}
+        assert report["summary"]["ok"] == 1
+        assert report["summary"]["failed"] == 3
+        json.dumps(report)
+
+    def test_ignores_json_files_that_are_not_sidecars(self, tmp_path):
+        save_firmware(tmp_path, "good.bin", b"good firmware")
+        (tmp_path / "report.json").write_text(json.dumps({"files": [], "summary": {}}))
+        (tmp_path / "list.json").write_text("[1, 2]")
+        (tmp_path / "broken.json").write_text("{")
+
+        report = notecard_firmware_verify.verify_firmware(str(tmp_path), workers=1)
+
+        assert statuses(report) == {"good.bin": "ok"}
+
+    def test_recursive(self, tmp_path):
+        (tmp_path / "sub").mkdir()
+        save_firmware(tmp_path / "sub", "nested.bin", b"nested")
+        assert notecard_firmware_verify.verify_firmware(str(tmp_path))["files"] == []
+        report = notecard_firmware_verify.verify_firmware(str(tmp_path), recursive=True)
+        assert statuses(report) == {"nested.bin": "ok"}
+
+    def test_compares_with_catalog(self, tmp_path):
+        save_firmware(tmp_path, "a.bin", b"a")
+        save_firmware(tmp_path, "b.bin", b"b")
+        save_firmware(tmp_path, "c.bin", b"c")
+        catalog = [{"name": "a.bin", "md5": hashlib.md5(b"a").hexdigest(), "length": 1},
+                   {"name": "b.bin", "md5": hashlib.md5(b"not b").hexdigest(), "length": 5}]
+
+        report = notecard_firmware_verify.verify_firmware(str(tmp_path), catalog=catalog)
+
+        assert {result["name"]: result["catalog"] for result in report["files"]} == \
+            {"a.bin": "ok", "b.bin": "mismatch", "c.bin": "absent"}
+        assert statuses(report) == {"a.bin": "ok", "b.bin": "mismatch", "c.bin": "ok"}
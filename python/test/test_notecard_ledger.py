@@ -0,0 +1,53 @@
+import pytest
+from notecard_ledger import Ledger
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    with Ledger(str(tmp_path / "ledger.db")) as ledger:
+        yield ledger
+
+
+class TestLedger:
+
+    def test_records_last_flash(self, ledger):
+        ledger.record("205B3875594D", name="a.bin", md5="aaa", version="5.1.1", method="dfu-util")
+        ledger.record("205B3875594D", name="b.bin", md5="bbb", version="5.2.1", method="dfu-util")
+        entry = ledger.get("205B3875594D")
+        assert entry["name"] == "b.bin"
+        assert entry["md5"] == "bbb"
+        assert entry["flashed_at"] > 0
+
+    def test_unknown_device(self, ledger):
+        assert ledger.get("UNKNOWN") is None
+        assert not ledger.is_flashed("UNKNOWN", md5="aaa")
+
+    def test_is_flashed(self, ledger):
+        ledger.record("205B3875594D", name="a.bin", md5="aaa", version="5.1.1")
+        assert ledger.is_flashed("205B3875594D", md5="aaa")
+        assert ledger.is_flashed("205B3875594D", name="a.bin", version="5.1.1")
+        assert not ledger.is_flashed("205B3875594D", md5="bbb")
+        assert not ledger.is_flashed("205B3875594D", md5="aaa", version="5.2.1")
+        # nothing expected never matches
+        assert not ledger.is_flashed("205B3875594D", md5=None)
+
+    def test_persists(self, tmp_path):
+        path = str(tmp_path / "ledger.db")
+        with Ledger(path) as ledger:
+            ledger.record("205B3875594D", md5="aaa")
+        with Ledger(path) as ledger:
+            assert ledger.is_flashed("205B3875594D", md5="aaa")
+
+    def test_query_devices(self, ledger):
+        ledger.record("A", md5="aaa")
+        ledger.record("B", md5="bbb")
+        ledger.record("C", md5="aaa")
+        assert [device["serial"] for device in ledger.devices(md5="aaa")] == ["A", "C"]
+        assert len(ledger.devices()) == 3
+        with pytest.raises(ValueError):
+            ledger.devices(colour="red")
+
+    def test_forget(self, ledger):
+        ledger.record("A", md5="aaa")
+        ledger.forget("A")
+        assert ledger.get("A") is None
@@ -0,0 +1,143 @@
+import argparse
+
+import pytest
+import notecard_local_firmware_notehub_update
+from notecard_ledger import Ledger
+
+
+class FakeCard:
+    """
+    A Notecard that records the requests made, and changes to `new_version` when a DFU completes.
+
+    When `drops` is set, the connection is lost once the DFU reaches that mode, as when the Notecard restarts to apply
+    the firmware.
+    """
+
+    def __init__(self, version, device="dev:864475044204278", new_version=None, drops=None):
+        self.version = version
+        self.new_version = new_version
+        self.device = device
+        self.drops = drops
+        self.dropped = False
+        self.requests = []
+        self.dfu_modes = []
+
+    def Transaction(self, req):
+        if self.dropped:
+            raise OSError("serial port closed")
+        self.requests.append(req)
+        if req["req"] == "card.version":
+            return {"version": self.version, "device": self.device}
+        if req["req"] == "dfu.status" and req.get("on"):
+            self.dfu_modes = ["downloading", "ready", "completed"]
+        if req["req"] == "dfu.status" and not req.get("on") and not req.get("off"):
+            mode = self.dfu_modes.pop(0) if len(self.dfu_modes) > 1 else self.dfu_modes[0]
+            if mode == self.drops:
+                self.dropped = True
+                self.version = self.new_version
+                self.dfu_modes = ["completed"]
+            if mode == "completed":
+                self.version = self.new_version
+            return {"mode": mode}
+        return {}
+
+    def reopen(self):
+        self.dropped = False
+        return self
+
+    def dfu_starts(self):
+        return sum(1 for req in self.requests if req["req"] == "dfu.status" and req.get("on"))
+
+
+def update_args(tmp_path, version=None):
+    return argparse.Namespace(serial_port="/dev/ttyACM0", baudrate=9600, filename="notecard-5.2.1.bin",
+                              version=version, retries=5, card_timeout=60, timeout=60,
+                              ledger=str(tmp_path / "ledger.db"))
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(notecard_local_firmware_notehub_update.time, "sleep", lambda secs: None)
+
+
+@pytest.fixture
+def restarting_card(monkeypatch):
+    """Run main() against a Notecard that drops the connection when it restarts to apply the firmware."""
+    pytest.importorskip("notecard")
+    card = FakeCard("notecard-5.1.1.16026", new_version="notecard-5.2.1.16100", drops="ready")
+    monkeypatch.setattr(notecard_local_firmware_notehub_update, "_open_notecard", lambda args: card.reopen())
+    return card
+
+
+class TestNotehubUpdate:
+
+    def test_skips_update_when_ledger_shows_firmware_flashed(self, tmp_path):
+        card = FakeCard("notecard-5.1.1.16026")
+        with Ledger(str(tmp_path / "ledger.db")) as ledger:
+            ledger.record(card.device, name="notecard-5.1.1.bin", version=card.version, method="notehub")
+            assert notecard_local_firmware_notehub_update._update_notecard_firmware(
+                card, "notecard-5.1.1.bin", None, 60, ledger) is False
+        assert [req["req"] for req in card.requests] == ["card.version"]
+
+    def test_skips_update_when_at_version(self):
+        card = FakeCard("notecard-5.1.1.16026")
+        assert notecard_local_firmware_notehub_update._update_notecard_firmware(
+            card, "notecard-5.1.1.bin", "notecard-5.1.1.16026", 60) is False
+        assert [req["req"] for req in card.requests] == ["card.version"]
+
+    def test_records_update_in_ledger_without_version(self, tmp_path):
+        pytest.importorskip("notecard")
+        card = FakeCard("notecard-5.1.1.16026", new_version="notecard-5.2.1.16100")
+        progress = {}
+        with Ledger(str(tmp_path / "ledger.db")) as ledger:
+            assert notecard_local_firmware_notehub_update._update_notecard_firmware(
+                card, "notecard-5.2.1.bin", None, 60, ledger, progress)
+            entry = ledger.get(card.device)
+        assert progress["download_secs"] >= 0
+        assert entry["name"] == "notecard-5.2.1.bin"
+        assert entry["version"] == "notecard-5.2.1.16100"
+        assert entry["method"] == "notehub"
+
+    def test_ignores_ledger_entries_from_other_methods(self, tmp_path):
+        pytest.importorskip("notecard")
+        card = FakeCard("notecard-5.1.1.16026", new_version="notecard-5.1.1.16026")
+        with Ledger(str(tmp_path / "ledger.db")) as ledger:
+            ledger.record(card.device, name="notecard-5.1.1.bin", version=card.version, method="dfu-util")
+            notecard_local_firmware_notehub_update._update_notecard_firmware(
+                card, "notecard-5.1.1.bin", None, 60, ledger)
+        assert {"req": "dfu.status", "on": True, "name": "card"} in card.requests
+
+    def test_version_required_without_ledger(self):
+        args = argparse.Namespace(version=None, ledger=None)
+        with pytest.raises(ValueError, match="version is required"):
+            notecard_local_firmware_notehub_update.validate_arguments(args)
+
+    @pytest.mark.parametrize("version", [None, "notecard-5.2.1.16100"])
+    def test_retry_after_restart_records_update(self, tmp_path, restarting_card, version):
+        notecard_local_firmware_notehub_update.main(update_args(tmp_path, version))
+
+        assert restarting_card.dfu_starts() == 1
+        with Ledger(str(tmp_path / "ledger.db")) as ledger:
+            entry = ledger.get(restarting_card.device)
+        assert entry["version"] == "notecard-5.2.1.16100"
+        assert entry["method"] == "notehub"
+        assert restarting_card.requests[-3:] == [{"req": "env.set", "name": "_fwc"},
+                                                 {"req": "env.set", "name": "_fwc_retry"},
+                                                 {"req": "hub.sync", "allow": True}]
+
+    def test_retry_after_restart_detects_version_mismatch(self, tmp_path, restarting_card):
+        restarting_card.new_version = "notecard-5.2.0.16000"
+        with pytest.raises(Exception, match="DFU update failed"):
+            notecard_local_firmware_notehub_update.main(update_args(tmp_path, "notecard-5.2.1.16100"))
+        assert restarting_card.dfu_starts() == 1
+
+    @pytest.mark.parametrize("drops", ["ready", "downloading"])
+    def test_retry_after_restart_returns_download_time(self, tmp_path, restarting_card, drops):
+        restarting_card.drops = drops
+        download_secs = notecard_local_firmware_notehub_update.main(update_args(tmp_path))
+        assert download_secs is not None and download_secs >= 0
+
+    def test_returns_none_when_already_updated(self, tmp_path, restarting_card):
+        restarting_card.version = restarting_card.new_version
+        assert notecard_local_firmware_notehub_update.main(update_args(tmp_path, restarting_card.version)) is None
+        assert restarting_card.dfu_starts() == 0
@@ -0,0 +1,127 @@
+import threading
+import time
+
+from notecard_rollout import RolloutScheduler
+
+
+class FakeFleet:
+    """Updates cards with a fixed duration, tracking how many are updated at once. Skipped cards are up to date."""
+
+    def __init__(self, duration=0.02, failing=(), skipped=()):
+        self.duration = duration
+        self.failing = set(failing)
+        self.skipped = set(skipped)
+        self.updated = []
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def update(self, card):
+        if card in self.skipped:
+            return None
+        with self._lock:
+            self.updated.append(card)
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            time.sleep(self.duration)
+            if card in self.failing:
+                raise TimeoutError(f"DFU update timeout for {card}")
+            return self.duration
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def cards(count):
+    return [f"/dev/ttyACM{i}" for i in range(count)]
+
+
+def statuses(results):
+    return [result["status"] for result in results]
+
+
+class TestRolloutScheduler:
+
+    def test_updates_all_cards(self):
+        fleet = FakeFleet()
+        scheduler = RolloutScheduler(fleet.update, max_concurrency=3)
+        results = scheduler.run(cards(10))
+        assert statuses(results) == ["ok"] * 10
+        assert 1 < fleet.peak <= 3
+        assert scheduler.peak_concurrency == fleet.peak
+
+    def test_canaries_run_first(self):
+        fleet = FakeFleet()
+        scheduler = RolloutScheduler(fleet.update, max_concurrency=4, canaries=2)
+        scheduler.run(cards(6))
+        assert sorted(fleet.updated[:2]) == cards(2)
+
+    def test_halts_when_canary_fails(self):
+        fleet = FakeFleet(failing=["/dev/ttyACM0"])
+        scheduler = RolloutScheduler(fleet.update, canaries=1)
+        results = scheduler.run(cards(5))
+        assert statuses(results) == ["failed"] + ["not started"] * 4
+        assert scheduler.halt_reason == "canary /dev/ttyACM0 failed"
+
+    def test_halts_on_error_rate(self):
+        fleet = FakeFleet(failing=cards(20)[1:])
+        scheduler = RolloutScheduler(fleet.update, max_concurrency=1, max_error_rate=0.5, min_samples=3)
+        results = scheduler.run(cards(20))
+        assert statuses(results)[:3] == ["ok", "failed", "failed"]
+        assert statuses(results)[3:] == ["not started"] * 17
+        assert "error rate 2/3" in scheduler.halt_reason
+
+    def test_bandwidth_budget_limits_concurrency(self):
+        # each card downloads 1000 bytes in 0.02s, 50,000 bytes per second, so 100,000 admits 2 cards
+        fleet = FakeFleet(duration=0.02)
+        scheduler = RolloutScheduler(fleet.update, max_concurrency=8, image_size=1000, bandwidth=100_000)
+        scheduler.run(cards(12))
+        assert fleet.peak <= 2
+        assert scheduler.bandwidth_limit() == 2
+
+    def test_skipped_cards_do_not_affect_admission(self):
+        fleet = FakeFleet(duration=0.02, skipped=cards(12)[4:])
+        scheduler = RolloutScheduler(fleet.update, max_concurrency=8, image_size=1000, bandwidth=100_000)
+        results = scheduler.run(cards(12))
+        assert statuses(results) == ["ok"] * 4 + ["skipped"] * 8
+        assert scheduler.skipped == 8
+        assert scheduler.fastest_secs == 0.02
+        assert scheduler.bandwidth_limit() == 2
+
+    def test_skipped_canary_does_not_stall_rollout(self):
+        fleet = FakeFleet(skipped=cards(1))
+        scheduler = RolloutScheduler(fleet.update, canaries=1)
+        results = scheduler.run(cards(4))
+        assert statuses(results) == ["skipped"] + ["ok"] * 3
+
+    def test_skipped_cards_are_not_counted_in_error_rate(self):
+        fleet = FakeFleet(failing=cards(4)[3:], skipped=cards(4)[1:3])
+        scheduler = RolloutScheduler(fleet.update, max_concurrency=1, max_error_rate=0.4, min_samples=2)
+        results = scheduler.run(cards(4))
+        assert statuses(results) == ["ok", "skipped", "skipped", "failed"]
+        assert "error rate 1/2" in scheduler.halt_reason
+
+
+class TestAdmission:
+
+    def test_grows_while_updates_are_fast(self):
+        scheduler = RolloutScheduler(None, max_concurrency=4)
+        for _ in range(5):
+            scheduler.record(10, True)
+        assert scheduler.admission_limit() == 4
+
+    def test_halves_when_updates_slow_down(self):
+        scheduler = RolloutScheduler(None, max_concurrency=8)
+        for _ in range(8):
+            scheduler.record(10, True)
+        assert scheduler.admission_limit() == 8
+        scheduler.record(20, True)
+        assert scheduler.admission_limit() == 4
+
+    def test_halves_on_failure(self):
+        scheduler = RolloutScheduler(None, max_concurrency=8, max_error_rate=1)
+        for _ in range(4):
+            scheduler.record(10, True)
+        scheduler.record(0, False)
+        assert scheduler.admission_limit() == 2
@@ -0,0 +1,72 @@
+import importlib
+import os
+import subprocess
+import sys
+
+import pytest
+
+import notecard_tools
+
+# Modules that must not be imported just to start the command line tools.
+heavy_modules = ["requests", "notecard", "serial", "urllib3"]
+
+# Budget for the cumulative import time of the command line tools when running dfu-util, in microseconds.
+# For comparison, importing `requests` alone typically takes over 100ms.
+import_time_budget_us = 50_000
+
+
+def import_times(*modules: str) -> dict:
+    """Import the modules in a fresh interpreter, returning the cumulative import time of each module imported."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"],
+                            cwd=os.path.dirname(notecard_tools.__file__),
+                            capture_output=True, encoding="utf-8", check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def parse_args(argv: list[str]):
+    return notecard_tools.build_parser(argv).parse_args(argv)
+
+
+class TestNotecardTools:
+
+    def test_parses_dfu_util_command(self):
+        args = parse_args(["dfu-util", "--serial-number", "205B3875594D", "-t", "10", "abc#def.bin"])
+        assert args.command == "dfu-util"
+        assert args.serial_number == "205B3875594D"
+        assert args.timeout == 10.0
+        assert args.filename == "abc#def.bin"
+        assert args.func == sys.modules["notecard_dfu_util"].main
+
+    def test_parses_notehub_update_command(self):
+        args = parse_args(["notehub-update", "-p", "/dev/ttyACM0", "-f", "abc#def.bin", "-v", "5.1.1", "-r", "2"])
+        assert args.serial_port == "/dev/ttyACM0"
+        assert args.retries == 2
+        assert args.func == sys.modules["notecard_local_firmware_notehub_update"].main
+
+    def test_every_command_module_has_arguments_and_main(self):
+        for module_name, _ in notecard_tools.commands.values():
+            module = importlib.import_module(module_name)
+            assert callable(module.add_arguments)
+            assert callable(module.main)
+
+    def test_startup_does_not_import_heavy_modules(self):
+        # the modules loaded by the command line tools when performing a DFU with dfu-util
+        times = import_times("notecard_tools", "notecard_dfu_util")
+        imported = [name for name in heavy_modules if name in times]
+        assert not imported
+
+    @pytest.mark.timing
+    def test_startup_import_time_within_budget(self):
+        def dfu_util_import_time():
+            times = import_times("notecard_tools", "notecard_dfu_util")
+            return times["notecard_tools"] + times["notecard_dfu_util"]
+
+        # take the best of a few runs to reduce noise from the host
+        best = min(dfu_util_import_time() for _ in range(3))
+        assert best < import_time_budget_us